@@ -0,0 +1,71 @@
+import zipfile
+from app.storage import COPY_CHUNK_SIZE
+
+# Members at least this large need zip64 local headers up front, because a
+# streamed entry cannot go back and rewrite its header
+_ZIP64_THRESHOLD = zipfile.ZIP64_LIMIT - 1024
+
+
+class _StreamSink:
+    """
+    只追加的输出对象：zipfile 写入的数据暂存于此，由生成器逐块取走。
+    没有 seek 方法，zipfile 会改用数据描述符，不回写本地文件头。
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(members, deflate=False):
+    """
+    边读边生成 ZIP，不落临时文件，内存占用为一个读取块。
+    members 为 (arcname, path, size, modified_at) 序列；
+    超过 4 GiB 的成员和超过 65535 个成员时使用 zip64。
+    """
+    sink = _StreamSink()
+    compression = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+    with zipfile.ZipFile(sink, "w", compression=compression, allowZip64=True) as zf:
+        for arcname, path, size, modified_at in members:
+            info = zipfile.ZipInfo(arcname, date_time=_zip_time(modified_at))
+            info.compress_type = compression
+            info.file_size = size
+            with (
+                open(path, "rb") as src,
+                zf.open(info, "w", force_zip64=size >= _ZIP64_THRESHOLD) as dest,
+            ):
+                for chunk in iter(lambda: src.read(COPY_CHUNK_SIZE), b""):
+                    dest.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    # Central directory
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def _zip_time(modified_at):
+    # ZIP timestamps cannot represent dates before 1980
+    if modified_at is None or modified_at.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return modified_at.timetuple()[:6]
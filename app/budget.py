@@ -0,0 +1,252 @@
+import threading
+import uuid
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, or_, select, update
+from app.config import settings
+from app.database import (
+    STORAGE_BYTES_COUNTER,
+    Clip,
+    Counter,
+    SessionLocal,
+    StorageReservation,
+    engine,
+    insert_ignore,
+    read_counter,
+)
+from app.metrics import evicted_bytes, evictions, rate_limited
+from app.storage import delete_clip
+
+logger = logging.getLogger(__name__)
+
+
+class StorageFull(Exception):
+    pass
+
+
+# Clips deleted per query while evicting
+_EVICTION_BATCH = 20
+
+# Policy name -> ORDER BY for eviction candidates, evicted first to last
+EVICTION_POLICIES = {
+    "expiry": lambda: (Clip.expires_at.asc(),),
+    "lru": lambda: (func.coalesce(Clip.last_accessed_at, Clip.created_at).asc(),),
+    "largest": lambda: (Clip.file_size.desc(),),
+}
+
+_evict_lock = threading.Lock()
+
+
+def used_bytes():
+    # Includes the space reserved by uploads still being written
+    return read_counter(STORAGE_BYTES_COUNTER)
+
+
+def reserved_bytes():
+    with engine.connect() as conn:
+        return conn.execute(
+            select(func.coalesce(func.sum(StorageReservation.amount), 0))
+        ).scalar()
+
+
+def status():
+    budget = settings.STORAGE_BUDGET_BYTES
+    return {
+        "used_bytes": used_bytes(),
+        "reserved_bytes": reserved_bytes(),
+        "budget_bytes": budget,
+        "high_water_bytes": int(budget * settings.STORAGE_HIGH_WATER),
+        "low_water_bytes": int(budget * settings.STORAGE_LOW_WATER),
+        "policy": settings.STORAGE_EVICTION_POLICY,
+    }
+
+
+def evict(amount, policy=None):
+    """
+    按淘汰策略删除占用文件存储的剪贴板，直到释放 amount 字节或没有可淘汰的剪贴板。
+    共享同一 blob 的剪贴板全部删除后才会释放空间。返回释放的字节数。
+    """
+    policy = policy or settings.STORAGE_EVICTION_POLICY
+    order_by = EVICTION_POLICIES.get(policy)
+    if order_by is None:
+        if policy != "none":
+            logger.error(f"Unknown storage eviction policy: {policy}")
+        return 0
+
+    freed = 0
+    evicted = 0
+    failed = False
+    with SessionLocal() as db:
+        while freed < amount and not failed:
+            candidates = (
+                db.query(Clip)
+                .filter(or_(Clip.file_path.isnot(None), Clip.content_type == "bundle"))
+                .order_by(*order_by(), Clip.id)
+                .limit(_EVICTION_BATCH)
+                .all()
+            )
+            if not candidates:
+                break
+            for clip in candidates:
+                try:
+                    # Only count what this deletion released, not what
+                    # concurrent uploads and deletes did to the total meanwhile
+                    released = delete_clip(db, clip)
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    logger.error(f"Evict clip {clip.code} failed: {e}")
+                    failed = True
+                    break
+                evicted += 1
+                freed += released
+                if freed >= amount:
+                    break
+
+    if evicted:
+        evictions.inc(policy, amount=evicted)
+        evicted_bytes.inc(policy, amount=freed)
+        logger.warning(
+            f"Evicted {evicted} clips ({freed} bytes) by {policy} policy "
+            f"to free storage"
+        )
+    return freed
+
+
+def _take(amount, limit):
+    # Check and add in one statement, so concurrent uploads on any worker
+    # cannot all pass the same check and overshoot the limit together
+    stmt = (
+        update(Counter)
+        .where(Counter.name == STORAGE_BYTES_COUNTER, Counter.value + amount <= limit)
+        .values(value=Counter.value + amount)
+    )
+    with engine.begin() as conn:
+        if conn.execute(stmt).rowcount:
+            return True
+        conn.execute(insert_ignore(Counter).values(name=STORAGE_BYTES_COUNTER, value=0))
+        return conn.execute(stmt).rowcount > 0
+
+
+def _admit(amount):
+    budget = settings.STORAGE_BUDGET_BYTES
+    if _take(amount, int(budget * settings.STORAGE_HIGH_WATER)):
+        return True
+    # Never evict for an upload that could not fit even into an empty store
+    if amount > budget:
+        return False
+    # One eviction pass per process at a time; later callers see its result
+    with _evict_lock:
+        used = used_bytes()
+        if used + amount > budget * settings.STORAGE_HIGH_WATER:
+            evict(used + amount - int(budget * settings.STORAGE_LOW_WATER))
+        return _take(amount, budget)
+
+
+class Reservation:
+    """
+    上传写入期间占用的存储预算，计入 storage_bytes 计数器，其他上传立即可见。
+    写入成功后 store_blob 按实际大小计入，随后 release 归还预留；
+    进程异常退出留下的预留在 STORAGE_RESERVATION_TTL 后由维护任务回收。
+    """
+
+    def __init__(self, reservation_id=None, ttl=None):
+        self.id = reservation_id or uuid.uuid4().hex
+        self.ttl = ttl or settings.STORAGE_RESERVATION_TTL
+
+    def grow(self, extra):
+        """
+        追加预留 extra 字节并续期；需要时先淘汰，仍超出预算时返回 False。
+        """
+        budget = settings.STORAGE_BUDGET_BYTES
+        if budget <= 0:
+            return True
+        if extra > 0 and not _admit(extra):
+            rate_limited.inc("storage")
+            logger.warning(
+                f"Rejected upload of {extra} more bytes: storage at "
+                f"{used_bytes()} of {budget}"
+            )
+            return False
+
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        with engine.begin() as conn:
+            updated = conn.execute(
+                update(StorageReservation)
+                .where(StorageReservation.id == self.id)
+                .values(amount=StorageReservation.amount + extra, expires_at=expires_at)
+            ).rowcount
+            if not updated:
+                # Also reached when MySQL reports an unchanged renewal as 0 rows
+                conn.execute(
+                    insert_ignore(StorageReservation).values(
+                        id=self.id, amount=extra, expires_at=expires_at
+                    )
+                )
+        return True
+
+    def renew(self):
+        return self.grow(0)
+
+    def release(self):
+        if settings.STORAGE_BUDGET_BYTES <= 0:
+            return
+        try:
+            _release_reservation(self.id)
+        except Exception as e:
+            # Returned to the budget by prune_reservations after the TTL
+            logger.warning(f"Release storage reservation {self.id} failed: {e}")
+
+
+def _release_reservation(reservation_id, expired_before=None):
+    # Deleting the exact amount read guards against a concurrent grow
+    for _ in range(3):
+        with engine.begin() as conn:
+            query = select(StorageReservation.amount).where(
+                StorageReservation.id == reservation_id
+            )
+            if expired_before is not None:
+                query = query.where(StorageReservation.expires_at < expired_before)
+            amount = conn.execute(query).scalar()
+            if amount is None:
+                return False
+            deleted = conn.execute(
+                delete(StorageReservation).where(
+                    StorageReservation.id == reservation_id,
+                    StorageReservation.amount == amount,
+                )
+            ).rowcount
+            if deleted:
+                conn.execute(
+                    update(Counter)
+                    .where(Counter.name == STORAGE_BYTES_COUNTER)
+                    .values(value=Counter.value - amount)
+                )
+                return True
+    return False
+
+
+def reserve_space(incoming, reservation_id=None, ttl=None):
+    """
+    写入文件前调用：预留 incoming 字节，用量将超过高水位时先淘汰到低水位。
+    返回 Reservation，调用方写入并登记后 release；超出预算时返回 None，
+    调用方以 507 拒绝上传。长度未知的上传以 0 开始，边写入边 grow。
+    """
+    reservation = Reservation(reservation_id, ttl)
+    if not reservation.grow(incoming):
+        return None
+    return reservation
+
+
+def prune_reservations():
+    """
+    归还已过期的预留（进程异常退出或会话过期留下的），返回归还的数量。
+    """
+    now = datetime.utcnow()
+    with engine.connect() as conn:
+        expired = list(
+            conn.execute(
+                select(StorageReservation.id).where(StorageReservation.expires_at < now)
+            ).scalars()
+        )
+    return sum(1 for rid in expired if _release_reservation(rid, now))
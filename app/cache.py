@@ -0,0 +1,207 @@
+import threading
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import case, select, update
+from app.config import settings
+from app.database import Clip, engine
+
+logger = logging.getLogger(__name__)
+
+# Rough per-entry bookkeeping cost on top of the content itself
+_ENTRY_OVERHEAD = 256
+
+
+class _Entry:
+    __slots__ = (
+        "content",
+        "content_type",
+        "content_encoding",
+        "expires_at",
+        "remaining",
+        "pending",
+        "size",
+        "loaded_at",
+    )
+
+    def __init__(self, content, content_type, content_encoding, expires_at, remaining):
+        self.content = content
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.expires_at = expires_at
+        self.remaining = remaining
+        self.pending = 0
+        self.size = len(content) + _ENTRY_OVERHEAD
+        self.loaded_at = time.monotonic()
+
+
+class ClipCache:
+    """
+    按取件码缓存热点文本/链接剪贴板的进程内 LRU 缓存。
+    访问次数先在内存中扣减，累计到一定数量或时间后批量写回数据库，
+    写回时同步数据库中的剩余次数（包含其他进程的消耗）。
+    剩余次数接近下限时条目被移出，之后的访问回到数据库精确计数。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def enabled(self):
+        return settings.CLIP_CACHE_MAX_BYTES > 0
+
+    def _reserve(self):
+        return settings.CLIP_CACHE_MIN_COUNT // 2
+
+    def should_cache(self, content, remaining):
+        return (
+            self.enabled
+            and remaining >= settings.CLIP_CACHE_MIN_COUNT
+            and len(content) + _ENTRY_OVERHEAD <= settings.CLIP_CACHE_MAX_ENTRY_BYTES
+        )
+
+    def _drop(self, code):
+        entry = self._entries.pop(code, None)
+        if entry is not None:
+            self._bytes -= entry.size
+        return entry
+
+    def put(
+        self, code, content, content_type, expires_at, remaining, content_encoding=None
+    ):
+        if not self.should_cache(content, remaining):
+            return
+        evicted = []
+        with self._lock:
+            old = self._drop(code)
+            if old is not None and old.pending:
+                evicted.append((code, old))
+            entry = _Entry(
+                content, content_type, content_encoding, expires_at, remaining
+            )
+            self._entries[code] = entry
+            self._bytes += entry.size
+            while self._bytes > settings.CLIP_CACHE_MAX_BYTES and self._entries:
+                old_code, old = self._entries.popitem(last=False)
+                self._bytes -= old.size
+                if old.pending:
+                    evicted.append((old_code, old))
+        for old_code, old in evicted:
+            self._write_back(old_code, old.pending)
+
+    def consume(self, code):
+        """
+        从缓存中消耗一次访问，返回 (content, content_type, content_encoding)；
+        未命中返回 None。
+        """
+        if not self.enabled:
+            return None
+        flush_now = False
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None:
+                return None
+            stale = (
+                datetime.utcnow() >= entry.expires_at
+                or time.monotonic() - entry.loaded_at > settings.CLIP_CACHE_TTL
+                or entry.remaining <= self._reserve()
+            )
+            if stale:
+                self._drop(code)
+                pending = entry.pending
+            else:
+                self._entries.move_to_end(code)
+                entry.remaining -= 1
+                entry.pending += 1
+                flush_now = entry.pending >= settings.CLIP_CACHE_FLUSH_EVERY
+                result = (entry.content, entry.content_type, entry.content_encoding)
+        if stale:
+            # Hand the code back to the exact database path
+            if pending:
+                self._write_back(code, pending)
+            return None
+
+        if flush_now:
+            self._flush_entry(code)
+        elif time.monotonic() - self._last_flush > settings.CLIP_CACHE_FLUSH_INTERVAL:
+            self.flush()
+        return result
+
+    def invalidate(self, code):
+        with self._lock:
+            entry = self._drop(code)
+        if entry is not None and entry.pending:
+            self._write_back(code, entry.pending)
+
+    def _take_pending(self, code):
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None or not entry.pending:
+                return 0
+            pending, entry.pending = entry.pending, 0
+            return pending
+
+    def _flush_entry(self, code):
+        pending = self._take_pending(code)
+        if not pending:
+            return
+        row = self._write_back(code, pending)
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None:
+                return
+            if row is None:
+                self._drop(code)
+            else:
+                # Pick up what other processes consumed meanwhile
+                entry.remaining = row.access_count - entry.pending
+                entry.expires_at = row.expires_at
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        with self._lock:
+            codes = [code for code, e in self._entries.items() if e.pending]
+        for code in codes:
+            self._flush_entry(code)
+
+    def _write_back(self, code, pending):
+        now = datetime.utcnow()
+        try:
+            with engine.begin() as conn:
+                # expires_at must see access_count before it changes
+                conn.execute(
+                    update(Clip)
+                    .where(Clip.code == code)
+                    .ordered_values(
+                        (
+                            Clip.expires_at,
+                            case(
+                                (Clip.access_count <= pending, now),
+                                else_=Clip.expires_at,
+                            ),
+                        ),
+                        (
+                            Clip.access_count,
+                            case(
+                                (
+                                    Clip.access_count > pending,
+                                    Clip.access_count - pending,
+                                ),
+                                else_=0,
+                            ),
+                        ),
+                    )
+                )
+                return conn.execute(
+                    select(Clip.access_count, Clip.expires_at).where(Clip.code == code)
+                ).first()
+        except Exception as e:
+            logger.warning(f"Flush access count failed {code}: {e}")
+            return None
+
+
+clip_cache = ClipCache()
@@ -0,0 +1,193 @@
+import hashlib
+import secrets
+import threading
+import uuid
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from app.config import settings
+from app.database import (
+    AppState,
+    Clip,
+    FreeCode,
+    engine,
+    reserve_counter,
+)
+
+logger = logging.getLogger(__name__)
+
+# Codes are stored in a String(10) column
+MAX_CODE_LENGTH = 10
+
+
+def _keyspace(length):
+    return 9 * 10 ** (length - 1)
+
+
+def _load_secret():
+    if settings.CODE_SECRET:
+        return settings.CODE_SECRET
+    # Every process must permute with the same key, so the first one to
+    # start persists a random secret and the others read it back
+    with engine.begin() as conn:
+        value = conn.execute(
+            select(AppState.value).where(AppState.key == "code_secret")
+        ).scalar()
+    if value:
+        return value
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                AppState.__table__.insert().values(
+                    key="code_secret", value=secrets.token_hex(16)
+                )
+            )
+    except IntegrityError:
+        pass
+    with engine.begin() as conn:
+        return conn.execute(
+            select(AppState.value).where(AppState.key == "code_secret")
+        ).scalar()
+
+
+_derived_keys = {}
+
+
+def secret_key(purpose):
+    """
+    由取件码密钥派生出指定用途的 HMAC 密钥，所有进程相同。
+    """
+    key = _derived_keys.get(purpose)
+    if key is None:
+        key = hashlib.blake2b(
+            purpose.encode(), key=_load_secret().encode()[:64], digest_size=32
+        ).digest()
+        _derived_keys[purpose] = key
+    return key
+
+
+class CodeAllocator:
+    """
+    无碰撞取件码分配器。
+    新码来自按长度划分的全局序号，经带密钥的 Feistel 置乱映射为随机外观的数字，
+    序号在数据库中按块预留，因此分配时无需逐个查询是否被占用。
+    号段占用超过阈值后自动增加长度，过期清理释放的码在延迟后优先复用。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = deque()
+        self._length = settings.CODE_MIN_LENGTH
+        self._key = None
+
+    def allocate(self):
+        with self._lock:
+            while not self._pool:
+                self._refill()
+            return self._pool.popleft()
+
+    def allocate_many(self, count):
+        with self._lock:
+            codes = []
+            while len(codes) < count:
+                while not self._pool:
+                    self._refill(count - len(codes))
+                codes.append(self._pool.popleft())
+            return codes
+
+    def _permute(self, seq, length):
+        # Feistel network over the smallest even bit width covering the
+        # keyspace, cycle-walking until the result falls inside it
+        n = _keyspace(length)
+        half_bits = ((n - 1).bit_length() + 1) // 2
+        mask = (1 << half_bits) - 1
+        x = seq
+        while True:
+            left, right = x >> half_bits, x & mask
+            for rnd in range(4):
+                digest = hashlib.blake2b(
+                    f"{length}:{rnd}:{right}".encode(), key=self._key, digest_size=8
+                ).digest()
+                left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+            x = (left << half_bits) | right
+            if x < n:
+                return str(10 ** (length - 1) + x)
+
+    def _refill(self, wanted=0):
+        if self._key is None:
+            self._key = hashlib.blake2b(
+                _load_secret().encode(), digest_size=32
+            ).digest()
+
+        block = max(settings.CODE_BLOCK_SIZE, wanted)
+        codes = self._claim_recycled(block)
+        if not codes:
+            codes = self._reserve_block(block)
+        self._pool.extend(codes)
+
+    def _claim_recycled(self, block):
+        token = uuid.uuid4().hex
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.CODE_RECYCLE_DELAY)
+        with engine.begin() as conn:
+            candidates = (
+                conn.execute(
+                    select(FreeCode.code)
+                    .where(FreeCode.freed_at < cutoff, FreeCode.claimed_by.is_(None))
+                    .order_by(FreeCode.freed_at)
+                    .limit(block)
+                )
+                .scalars()
+                .all()
+            )
+            if not candidates:
+                return []
+            # Another process may claim some of the same rows first
+            conn.execute(
+                update(FreeCode)
+                .where(FreeCode.code.in_(candidates), FreeCode.claimed_by.is_(None))
+                .values(claimed_by=token)
+            )
+            claimed = (
+                conn.execute(select(FreeCode.code).where(FreeCode.claimed_by == token))
+                .scalars()
+                .all()
+            )
+            conn.execute(delete(FreeCode).where(FreeCode.claimed_by == token))
+        return claimed
+
+    def _reserve_block(self, block):
+        while True:
+            limit = int(_keyspace(self._length) * settings.CODE_FILL_THRESHOLD)
+            start = reserve_counter(f"code_seq_{self._length}", block)
+            if start < limit:
+                break
+            if self._length >= MAX_CODE_LENGTH:
+                raise RuntimeError("Code space exhausted")
+            self._length += 1
+            logger.info(f"Code length grown to {self._length}")
+
+        codes = [
+            self._permute(seq, self._length)
+            for seq in range(start, min(start + block, limit))
+        ]
+        # Random codes issued before the allocator, and codes waiting to be
+        # recycled, live in the same keyspace
+        with engine.begin() as conn:
+            taken = set(
+                conn.execute(select(Clip.code).where(Clip.code.in_(codes))).scalars()
+            )
+            taken.update(
+                conn.execute(
+                    select(FreeCode.code).where(FreeCode.code.in_(codes))
+                ).scalars()
+            )
+        return [c for c in codes if c not in taken]
+
+
+code_allocator = CodeAllocator()
+
+
+def allocate_code():
+    return code_allocator.allocate()
@@ -0,0 +1,25 @@
+import gzip
+from app.config import settings
+
+GZIP = "gzip"
+
+
+def compress_text(content: str):
+    """
+    文本超过阈值且压缩有收益时返回 (encoding, payload)，否则返回 None。
+    payload 是完整的 gzip 流，可直接作为 Content-Encoding: gzip 的响应体。
+    """
+    raw = content.encode("utf-8")
+    if len(raw) < settings.TEXT_COMPRESS_MIN_SIZE:
+        return None
+    # mtime=0 keeps the output identical for identical text
+    payload = gzip.compress(raw, compresslevel=settings.TEXT_COMPRESS_LEVEL, mtime=0)
+    if len(payload) >= len(raw) * settings.TEXT_COMPRESS_MAX_RATIO:
+        return None
+    return GZIP, payload
+
+
+def decompress_text(encoding, payload: bytes) -> str:
+    if encoding != GZIP:
+        raise ValueError(f"Unknown content encoding {encoding}")
+    return gzip.decompress(payload).decode("utf-8")
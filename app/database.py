@@ -2,36 +2,98 @@ from sqlalchemy import (
     create_engine,
     Column,
     Integer,
+    LargeBinary,
     String,
     Enum,
+    Float,
     Text,
+    UniqueConstraint,
     BigInteger,
+    Boolean,
     DateTime,
-    text,
+    case,
+    delete,
+    event,
+    insert,
+    select,
+    update,
 )
+from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, declarative_base
 from datetime import datetime, timedelta
 import os
+import json
+import time
+import shutil
 import logging
 from app.config import settings
+from app.metrics import cleanup_duration, cleanup_removed, instrument_engine
 
 logger = logging.getLogger(__name__)
 
-engine = create_engine(settings.DATABASE_URL, pool_recycle=3600, pool_pre_ping=True)
+
+def _create_engine(url):
+    if not url.startswith("sqlite"):
+        return create_engine(url, pool_recycle=3600, pool_pre_ping=True)
+
+    # Embedded SQLite: one file, WAL so readers never block the writer
+    database = url.split("///", 1)[-1]
+    if database and database != ":memory:":
+        os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+    sqlite_engine = create_engine(
+        url,
+        connect_args={
+            "check_same_thread": False,
+            "timeout": settings.SQLITE_BUSY_TIMEOUT_MS / 1000,
+        },
+    )
+
+    @event.listens_for(sqlite_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{settings.SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return sqlite_engine
+
+
+engine = _create_engine(settings.DATABASE_URL)
+instrument_engine(engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+def _default_expires_at(context):
+    expire_seconds = context.get_current_parameters().get("expire_seconds")
+    if expire_seconds is None:
+        expire_seconds = 604800
+    return datetime.utcnow() + timedelta(seconds=expire_seconds)
+
+
 class Clip(Base):
     __tablename__ = "cb_clips"
 
     id = Column(Integer, primary_key=True)
     code = Column(String(10), unique=True, nullable=False, index=True)
     content_type = Column(
-        Enum("text/plain", "link", "file", name="content_type_enum"), nullable=False
+        Enum("text/plain", "link", "file", "bundle", name="content_type_enum"),
+        nullable=False,
     )
     content = Column(Text, nullable=True)
+    # Large text is stored compressed here instead, tagged by content_encoding
+    content_blob = Column(
+        LargeBinary().with_variant(mysql.MEDIUMBLOB(), "mysql"), nullable=True
+    )
+    content_encoding = Column(String(16), nullable=True)
     filename = Column(String(255), nullable=True)
     file_path = Column(String(500), nullable=True)
     file_hash = Column(String(64), nullable=True, index=True)
@@ -43,8 +105,15 @@ class Clip(Base):
     expire_seconds = Column(Integer, nullable=False, default=604800)
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    expires_at = Column(
+        DateTime, nullable=True, index=True, default=_default_expires_at
+    )
+    # Set by consume_access, used by the lru eviction policy
+    last_accessed_at = Column(DateTime, nullable=True)
 
     def is_expired(self):
+        if self.expires_at:
+            return datetime.utcnow() > self.expires_at
         if not self.created_at:
             return True
         expire_time = self.created_at + timedelta(seconds=self.expire_seconds)
@@ -60,29 +129,272 @@ class Clip(Base):
         return not self.is_expired() and self.access_count > 0
 
 
-def init_database():
+class ClipFile(Base):
+    """
+    多文件剪贴板（bundle）的成员，每个成员引用一个 blob。
+    """
+
+    __tablename__ = "cb_clip_files"
+    __table_args__ = (UniqueConstraint("clip_id", "position"),)
+
+    id = Column(Integer, primary_key=True)
+    clip_id = Column(Integer, nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    filename = Column(String(500), nullable=False)
+    file_hash = Column(String(64), nullable=False, index=True)
+    file_path = Column(String(500), nullable=False)
+    file_size = Column(BigInteger, nullable=False)
+    mime_type = Column(String(100), nullable=True)
+
+
+class Blob(Base):
+    __tablename__ = "cb_blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    path = Column(String(500), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    mime_type = Column(String(100), nullable=True)
+    refcount = Column(Integer, nullable=False, default=0)
+    # False for blobs imported from client-supplied hashes
+    verified = Column(Boolean, nullable=False, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class UploadSession(Base):
+    __tablename__ = "cb_upload_sessions"
+
+    id = Column(String(32), primary_key=True)
+    filename = Column(String(255), nullable=False)
+    file_size = Column(BigInteger, nullable=False)
+    chunk_size = Column(Integer, nullable=False)
+    total_chunks = Column(Integer, nullable=False)
+    client_hash = Column(String(64), nullable=True)
+    client_ip = Column(String(45), nullable=True)
+    access_count = Column(Integer, nullable=False, default=1000)
+    expire_seconds = Column(Integer, nullable=False, default=604800)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def chunk_length(self, index):
+        return max(0, min(self.chunk_size, self.file_size - index * self.chunk_size))
+
+
+class HashJob(Base):
+    __tablename__ = "cb_hash_jobs"
+
+    id = Column(Integer, primary_key=True)
+    clip_id = Column(Integer, nullable=False)
+    sha256 = Column(String(64), nullable=False)
+    path = Column(String(500), nullable=False)
+    # Worker process running the job; stale claims are taken over
+    owner = Column(String(32), nullable=True, index=True)
+    claimed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class HashResult(Base):
+    __tablename__ = "cb_hash_results"
+
+    # Keyed by file identity, so renaming a file keeps its cached digest
+    dev = Column(BigInteger, primary_key=True, autoincrement=False)
+    inode = Column(BigInteger, primary_key=True, autoincrement=False)
+    size = Column(BigInteger, nullable=False)
+    mtime_ns = Column(BigInteger, nullable=False)
+    sha256 = Column(String(64), nullable=False)
+
+
+class AppState(Base):
+    __tablename__ = "cb_app_state"
+
+    key = Column(String(64), primary_key=True)
+    value = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+def get_state(db, key, default=None):
+    row = db.query(AppState).filter_by(key=key).first()
+    if not row or row.value is None:
+        return default
     try:
-        Base.metadata.create_all(bind=engine)
-        logger.info("Database tables created successfully")
+        return json.loads(row.value)
+    except ValueError:
+        return default
+
+
+def set_state(db, key, value):
+    row = db.query(AppState).filter_by(key=key).first()
+    if not row:
+        row = AppState(key=key)
+        db.add(row)
+    row.value = json.dumps(value)
+
+
+class Counter(Base):
+    __tablename__ = "cb_counters"
+
+    name = Column(String(64), primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+# Total size of stored blobs, kept in step with cb_blobs by the storage layer,
+# plus the space reserved in cb_storage_reservations by uploads in flight
+STORAGE_BYTES_COUNTER = "storage_bytes"
+
+
+class StorageReservation(Base):
+    __tablename__ = "cb_storage_reservations"
+
+    id = Column(String(32), primary_key=True)
+    amount = Column(BigInteger, nullable=False, default=0)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+def adjust_counter(db, name, amount):
+    """
+    在调用方的事务中增减计数器，随事务一起提交或回滚。
+    """
+    stmt = update(Counter).where(Counter.name == name)
+    if not db.execute(stmt.values(value=Counter.value + amount)).rowcount:
+        db.execute(insert_ignore(Counter).values(name=name, value=0))
+        db.execute(stmt.values(value=Counter.value + amount))
+
+
+def read_counter(name):
+    with engine.connect() as conn:
+        value = conn.execute(select(Counter.value).where(Counter.name == name)).scalar()
+    return value or 0
 
+
+class FreeCode(Base):
+    __tablename__ = "cb_free_codes"
+
+    code = Column(String(10), primary_key=True)
+    freed_at = Column(DateTime, nullable=False, index=True)
+    claimed_by = Column(String(32), nullable=True, index=True)
+
+
+def reserve_counter(name, amount):
+    """
+    原子地把计数器增加 amount，返回增加前的值。
+    使用独立连接提交，不影响调用方的事务。
+    """
+    for _ in range(3):
+        with engine.begin() as conn:
+            updated = conn.execute(
+                update(Counter)
+                .where(Counter.name == name)
+                .values(value=Counter.value + amount)
+            ).rowcount
+            if updated:
+                value = conn.execute(
+                    select(Counter.value).where(Counter.name == name)
+                ).scalar()
+                return value - amount
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert(Counter).values(name=name, value=amount))
+            return 0
+        except IntegrityError:
+            continue
+    raise RuntimeError(f"Could not reserve counter {name}")
+
+
+class Lease(Base):
+    __tablename__ = "cb_leases"
+
+    name = Column(String(64), primary_key=True)
+    owner = Column(String(32), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+def acquire_lease(name, owner, ttl):
+    """
+    获取或续期命名租约，同一时间只有一个 owner 持有，返回是否持有。
+    使用独立连接提交，不影响调用方的事务。
+    """
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl)
+    with engine.begin() as conn:
+        updated = conn.execute(
+            update(Lease)
+            .where(
+                Lease.name == name,
+                (Lease.owner == owner) | (Lease.expires_at < now),
+            )
+            .values(owner=owner, expires_at=expires_at)
+        ).rowcount
+        if updated:
+            return True
+    try:
         with engine.begin() as conn:
-            check_sql = text("""
-                SELECT COUNT(*) AS cnt
-                FROM information_schema.COLUMNS
-                WHERE TABLE_SCHEMA = DATABASE()
-                  AND TABLE_NAME = 'cb_clips'
-                  AND COLUMN_NAME = 'client_ip'
-            """)
-            result = conn.execute(check_sql).scalar()
-            if not result:
-                conn.execute(
-                    text(
-                        "ALTER TABLE cb_clips ADD COLUMN client_ip VARCHAR(45) NULL AFTER mime_type"
-                    )
+            conn.execute(
+                insert(Lease).values(name=name, owner=owner, expires_at=expires_at)
+            )
+        return True
+    except IntegrityError:
+        pass
+    # MySQL reports 0 affected rows when a renewal writes identical values
+    with engine.begin() as conn:
+        holder = conn.execute(select(Lease.owner).where(Lease.name == name)).scalar()
+    return holder == owner
+
+
+def release_lease(name, owner):
+    with engine.begin() as conn:
+        conn.execute(delete(Lease).where(Lease.name == name, Lease.owner == owner))
+
+
+def lease_active(name):
+    with engine.connect() as conn:
+        return (
+            conn.execute(
+                select(Lease.name).where(
+                    Lease.name == name, Lease.expires_at >= datetime.utcnow()
                 )
-                logger.info("Added client_ip column to cb_clips")
-    except Exception as e:
-        logger.error(f"Database init failed: {e}")
+            ).first()
+            is not None
+        )
+
+
+def prune_leases():
+    # Expired leases are taken over on the next acquire anyway
+    with engine.begin() as conn:
+        return conn.execute(
+            delete(Lease).where(Lease.expires_at < datetime.utcnow())
+        ).rowcount
+
+
+class RateBucket(Base):
+    __tablename__ = "cb_rate_buckets"
+
+    key = Column(String(128), primary_key=True)
+    tokens = Column(Float(precision=53), nullable=False)
+    # Epoch seconds, compared exactly in the optimistic update
+    updated_at = Column(Float(precision=53), nullable=False, index=True)
+
+
+def insert_ignore(model):
+    """
+    主键冲突时不报错、不影响当前事务的 INSERT；通过 rowcount 判断是否插入。
+    """
+    if engine.dialect.name == "mysql":
+        return insert(model).prefix_with("IGNORE")
+    if engine.dialect.name == "sqlite":
+        return sqlite_insert(model).on_conflict_do_nothing()
+    return postgresql_insert(model).on_conflict_do_nothing()
+
+
+def recycle_codes(db, codes):
+    if codes:
+        now = datetime.utcnow()
+        db.execute(insert(FreeCode), [{"code": c, "freed_at": now} for c in codes])
+
+
+UPLOAD_SESSION_DIR = os.path.join(settings.DATA_DIR, ".uploads")
+
+
+def upload_session_dir(session_id):
+    return os.path.join(UPLOAD_SESSION_DIR, session_id)
 
 
 def get_db():
@@ -93,37 +405,127 @@ def get_db():
         db.close()
 
 
-def cleanup_expired_clips(db):
+def consume_access(db, code):
+    """
+    原子地消耗一次访问次数，返回是否允许本次访问。
+    次数用尽时把 expires_at 设为当前时间（文件为续传宽限期结束时间），
+    交给过期清理回收。调用方负责提交事务。
+    """
+    now = datetime.utcnow()
+    resume_until = now + timedelta(seconds=settings.FILE_RESUME_GRACE_SECONDS)
+    stmt = (
+        update(Clip)
+        .where(Clip.code == code, Clip.access_count > 0, Clip.expires_at > now)
+        # MySQL applies SET assignments left to right, so expires_at must
+        # read access_count before it is decremented
+        .ordered_values(
+            (
+                Clip.expires_at,
+                case(
+                    (Clip.access_count > 1, Clip.expires_at),
+                    (Clip.content_type != "file", now),
+                    (Clip.expires_at < resume_until, Clip.expires_at),
+                    else_=resume_until,
+                ),
+            ),
+            (Clip.access_count, Clip.access_count - 1),
+            (Clip.last_accessed_at, now),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return db.execute(stmt).rowcount > 0
+
+
+def cleanup_expired_clips(db, batch_size=None):
+    from app.storage import release_bundle_members, release_clip_files
+    from app.cache import clip_cache
+
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    cleaned_count = 0
+    started = time.perf_counter()
     try:
-        # manual cleanup since we are not using complex db specific functions
-        expired_clips = db.query(Clip).all()
-        expired_clips = [c for c in expired_clips if c.is_expired()]
+        while True:
+            now = datetime.utcnow()
+            expired = (
+                db.query(
+                    Clip.id,
+                    Clip.code,
+                    Clip.content_type,
+                    Clip.file_hash,
+                    Clip.file_path,
+                )
+                .filter(Clip.expires_at < now)
+                .order_by(Clip.expires_at)
+                .limit(batch_size)
+                .all()
+            )
+            if not expired:
+                break
 
-        cleaned_count = 0
-        for clip in expired_clips:
-            if clip.content_type == "file" and clip.file_path:
-                try:
-                    other_refs = 0
-                    if clip.file_hash:
-                        other_refs = (
-                            db.query(Clip)
-                            .filter(
-                                Clip.file_hash == clip.file_hash, Clip.id != clip.id
-                            )
-                            .count()
-                        )
-                    if other_refs == 0 and os.path.exists(clip.file_path):
-                        os.remove(clip.file_path)
-                        logger.info(f"Deleted file: {clip.file_path}")
-                except OSError as e:
-                    logger.warning(f"Delete file failed {clip.file_path}: {e}")
-
-            db.delete(clip)
+            deleted = (
+                db.query(Clip)
+                .filter(Clip.id.in_([c.id for c in expired]), Clip.expires_at < now)
+                .delete(synchronize_session=False)
+            )
+            if deleted != len(expired):
+                # Some rows went away concurrently; only release what we delete
+                db.rollback()
+                removed = [
+                    clip
+                    for clip in expired
+                    if db.query(Clip)
+                    .filter(Clip.id == clip.id)
+                    .delete(synchronize_session=False)
+                ]
+                deleted = len(removed)
+            else:
+                removed = expired
+
+            for clip in removed:
+                release_clip_files(db, clip)
+                clip_cache.invalidate(clip.code)
+            release_bundle_members(
+                db, [c.id for c in removed if c.content_type == "bundle"]
+            )
+            recycle_codes(db, [clip.code for clip in removed])
+
+            db.commit()
+            cleaned_count += deleted
+            if len(expired) < batch_size:
+                break
+
+        return cleaned_count
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Cleanup expired clips failed: {e}")
+        return cleaned_count
+    finally:
+        cleanup_duration.observe(time.perf_counter() - started, "clips")
+        cleanup_removed.inc("clips", amount=cleaned_count)
+
+
+def cleanup_expired_upload_sessions(db):
+    cleaned_count = 0
+    started = time.perf_counter()
+    try:
+        expired_sessions = (
+            db.query(UploadSession)
+            .filter(UploadSession.expires_at < datetime.utcnow())
+            .all()
+        )
+
+        for session in expired_sessions:
+            shutil.rmtree(upload_session_dir(session.id), ignore_errors=True)
+            db.delete(session)
             cleaned_count += 1
 
         db.commit()
         return cleaned_count
     except Exception as e:
         db.rollback()
-        logger.error(f"Cleanup expired clips failed: {e}")
-        return 0
+        logger.error(f"Cleanup upload sessions failed: {e}")
+        cleaned_count = 0
+        return cleaned_count
+    finally:
+        cleanup_duration.observe(time.perf_counter() - started, "upload_sessions")
+        cleanup_removed.inc("upload_sessions", amount=cleaned_count)
@@ -0,0 +1,263 @@
+import os
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, or_, select, update
+from app.config import settings
+from app.database import Blob, Clip, HashJob, HashResult, SessionLocal, engine
+from app.metrics import hash_bytes, hash_queue_depth, hash_seconds
+from app.storage import (
+    delete_clip,
+    hash_file,
+    purge_blob,
+    remember_verified_digest,
+    verified_digest,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def cached_digest(path):
+    """
+    返回文件已知的 SHA-256：先查进程内缓存，再查 cb_hash_results。
+    按 (设备, inode, 大小, mtime) 匹配，文件被替换或修改后不会命中。
+    """
+    digest = verified_digest(path)
+    if digest is not None:
+        return digest
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    with engine.connect() as conn:
+        digest = conn.execute(
+            select(HashResult.sha256).where(
+                HashResult.dev == st.st_dev,
+                HashResult.inode == st.st_ino,
+                HashResult.size == st.st_size,
+                HashResult.mtime_ns == st.st_mtime_ns,
+            )
+        ).scalar()
+    if digest is not None:
+        remember_verified_digest(path, digest)
+    return digest
+
+
+def remember_digest(path, digest):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    remember_verified_digest(path, digest)
+    with engine.begin() as conn:
+        conn.execute(
+            delete(HashResult).where(
+                HashResult.dev == st.st_dev, HashResult.inode == st.st_ino
+            )
+        )
+        conn.execute(
+            insert(HashResult).values(
+                dev=st.st_dev,
+                inode=st.st_ino,
+                size=st.st_size,
+                mtime_ns=st.st_mtime_ns,
+                sha256=digest,
+            )
+        )
+
+
+def _verify(trusted_hash, path):
+    if not os.path.exists(path):
+        return
+    digest = cached_digest(path)
+    if digest is None:
+        started = time.perf_counter()
+        digest = hash_file(path)
+        hash_seconds.inc(amount=time.perf_counter() - started)
+        hash_bytes.inc(amount=os.path.getsize(path))
+        remember_digest(path, digest)
+
+    with SessionLocal() as db:
+        if digest == trusted_hash:
+            db.query(Blob).filter_by(sha256=trusted_hash).update({Blob.verified: True})
+            db.commit()
+            return
+
+        blob = db.get(Blob, trusted_hash)
+        if blob is None or blob.verified or blob.path != path:
+            # Already gone, or replaced by an upload that was hashed on arrival
+            return
+        # Drop every clip on the blob and the blob itself, so instant
+        # uploads stop matching content that is not what the hash promised
+        stale = db.query(Clip).filter(Clip.file_hash == trusted_hash).all()
+        for clip in stale:
+            delete_clip(db, clip)
+        purge_blob(db, trusted_hash)
+        db.commit()
+        logger.warning(
+            f"Blob {trusted_hash} failed verification, removed {len(stale)} clips"
+        )
+
+
+def queue_unverified_blobs(limit=None):
+    """
+    为从客户端摘要导入、尚未校验的 blob 登记校验任务，返回登记的数量。
+    这些 blob 校验通过前不会被秒传命中。
+    """
+    with SessionLocal() as db:
+        rows = (
+            db.query(Blob.sha256, Blob.path, func.min(Clip.id))
+            .join(Clip, Clip.file_hash == Blob.sha256)
+            .filter(Blob.verified.is_(False))
+            .group_by(Blob.sha256, Blob.path)
+            .limit(limit or settings.CLEANUP_BATCH_SIZE)
+            .all()
+        )
+    for sha256, path, clip_id in rows:
+        hash_pool.submit(clip_id, sha256, path)
+    return len(rows)
+
+
+class HashPool:
+    """
+    与请求线程池隔离的哈希校验线程池。
+    任务先写入 cb_hash_jobs 再执行，进程重启后由 start 重新认领；
+    每个进程最多 HASH_QUEUE_SIZE 个任务在排队或执行，其余留在表中等待空位，
+    多个 worker 通过条件 UPDATE 认领，互不重复。
+    hashlib 计算大块数据时释放 GIL，线程之间可以并行。
+    """
+
+    def __init__(self):
+        self._owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._executor = None
+        # Jobs claimed by this process and not finished yet
+        self._pending = 0
+
+    def start(self):
+        if self._executor is not None:
+            return
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.HASH_WORKERS, thread_name_prefix="hash"
+        )
+        self._pump()
+
+    def stop(self):
+        if self._executor is None:
+            return
+        executor, self._executor = self._executor, None
+        executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            self._pending = 0
+        hash_queue_depth.set(0)
+        # Hand unfinished jobs back instead of waiting for the claim timeout
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    update(HashJob)
+                    .where(HashJob.owner == self._owner)
+                    .values(owner=None, claimed_at=None)
+                )
+        except Exception as e:
+            logger.warning(f"Release hash jobs failed: {e}")
+
+    def submit(self, clip_id, sha256, path):
+        """
+        登记一次校验，有空位时立即执行；队列已满时只持久化，等待空位。
+        同一摘要已有任务排队时不重复登记。
+        """
+        try:
+            with engine.begin() as conn:
+                queued = conn.execute(
+                    select(HashJob.id).where(HashJob.sha256 == sha256).limit(1)
+                ).first()
+                if queued:
+                    return
+                conn.execute(
+                    insert(HashJob).values(
+                        clip_id=clip_id,
+                        sha256=sha256,
+                        path=path,
+                        created_at=datetime.utcnow(),
+                    )
+                )
+        except Exception as e:
+            # The blob stays unverified, and a miss, until maintenance queues it again
+            logger.warning(f"Queue hash job for {sha256} failed: {e}")
+            return
+        self._pump()
+
+    def _claim(self, limit):
+        now = datetime.utcnow()
+        claimable = or_(
+            HashJob.owner.is_(None),
+            HashJob.claimed_at < now - timedelta(seconds=settings.HASH_JOB_TIMEOUT),
+        )
+        claimed = []
+        with engine.begin() as conn:
+            candidates = conn.execute(
+                select(HashJob.id, HashJob.clip_id, HashJob.sha256, HashJob.path)
+                .where(claimable)
+                .order_by(HashJob.id)
+                .limit(limit)
+            ).all()
+        for job in candidates:
+            with engine.begin() as conn:
+                updated = conn.execute(
+                    update(HashJob)
+                    .where(HashJob.id == job.id, claimable)
+                    .values(owner=self._owner, claimed_at=now)
+                ).rowcount
+            if updated:
+                claimed.append(tuple(job))
+        return claimed
+
+    def _pump(self):
+        executor = self._executor
+        if executor is None:
+            return
+        with self._lock:
+            free = settings.HASH_QUEUE_SIZE - self._pending
+            if free <= 0:
+                # Backpressure: the rest waits in the table for a free slot
+                return
+            self._pending += free
+        try:
+            jobs = self._claim(free)
+        except Exception as e:
+            logger.warning(f"Claim hash jobs failed: {e}")
+            jobs = []
+        with self._lock:
+            self._pending -= free - len(jobs)
+
+        for index, job in enumerate(jobs):
+            hash_queue_depth.inc()
+            try:
+                executor.submit(self._run, job)
+            except RuntimeError:
+                # Shut down meanwhile; stop() hands the claims back
+                hash_queue_depth.dec(amount=len(jobs) - index)
+                with self._lock:
+                    self._pending -= len(jobs) - index
+                return
+
+    def _run(self, job):
+        job_id, _, sha256, path = job
+        try:
+            _verify(sha256, path)
+            with engine.begin() as conn:
+                conn.execute(delete(HashJob).where(HashJob.id == job_id))
+        except Exception as e:
+            # Left claimed, so it is retried after HASH_JOB_TIMEOUT
+            logger.error(f"Hash job {job_id} failed: {e}")
+        finally:
+            hash_queue_depth.dec()
+            with self._lock:
+                self._pending -= 1
+        self._pump()
+
+
+hash_pool = HashPool()
@@ -0,0 +1,379 @@
+import bisect
+import threading
+import time
+from app.config import settings
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        value = value.replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(labels)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+            for k, v in items
+        ]
+
+
+class Gauge(_Metric):
+    """
+    可设置或增减的瞬时值；传入 collect 时在抓取时调用以取得当前值。
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._collect = collect
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def _samples(self):
+        if self._collect is not None:
+            try:
+                self.set(self._collect())
+            except Exception:
+                pass
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}"
+            for k, v in items
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [per-bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        names = self.labelnames + ("le",)
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                labels = _format_labels(names, key + (_format_value(float(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), collect=None):
+    return registry.register(Gauge(name, documentation, labelnames, collect))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# HTTP
+http_request_duration = histogram(
+    "clipbox_http_request_duration_seconds",
+    "Time spent serving HTTP requests.",
+    ("method", "route", "status"),
+)
+http_request_bytes = counter(
+    "clipbox_http_request_bytes_total",
+    "Request body bytes received.",
+    ("route",),
+)
+http_response_bytes = counter(
+    "clipbox_http_response_bytes_total",
+    "Response body bytes sent.",
+    ("route",),
+)
+
+# Uploads
+upload_bytes = counter(
+    "clipbox_upload_bytes_total",
+    "Bytes of file content accepted from uploads.",
+    ("kind",),
+)
+instant_upload = counter(
+    "clipbox_instant_upload_total",
+    "Instant upload lookups by result.",
+    ("result",),
+)
+
+rate_limited = counter(
+    "clipbox_rate_limited_total",
+    "Requests rejected by rate limiting or upload admission.",
+    ("reason",),
+)
+upload_in_flight_bytes = gauge(
+    "clipbox_upload_in_flight_bytes",
+    "Upload bytes admitted and not yet finished.",
+)
+
+# Background hash verification
+hash_queue_depth = gauge(
+    "clipbox_hash_queue_depth",
+    "Hash verifications scheduled but not finished.",
+)
+hash_bytes = counter(
+    "clipbox_hash_bytes_total",
+    "Bytes read by background hash verification.",
+)
+hash_seconds = counter(
+    "clipbox_hash_seconds_total",
+    "Time spent in background hash verification.",
+)
+
+# Cleanup
+cleanup_duration = histogram(
+    "clipbox_cleanup_duration_seconds",
+    "Duration of cleanup passes.",
+    ("task",),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+cleanup_removed = counter(
+    "clipbox_cleanup_removed_total",
+    "Items removed by cleanup passes.",
+    ("task",),
+)
+
+
+def _storage_used_bytes():
+    from app.budget import used_bytes
+
+    return used_bytes()
+
+
+# Storage budget
+storage_used_bytes = gauge(
+    "clipbox_storage_used_bytes",
+    "Bytes of stored blob files plus space reserved by uploads in flight.",
+    collect=_storage_used_bytes,
+)
+storage_budget_bytes = gauge(
+    "clipbox_storage_budget_bytes",
+    "Configured storage budget, 0 when unlimited.",
+    collect=lambda: settings.STORAGE_BUDGET_BYTES,
+)
+evictions = counter(
+    "clipbox_evictions_total",
+    "Clips deleted to free storage space.",
+    ("policy",),
+)
+evicted_bytes = counter(
+    "clipbox_evicted_bytes_total",
+    "Storage bytes freed by eviction.",
+    ("policy",),
+)
+
+
+def instrument_engine(engine):
+    """
+    统计连接池的借出次数，并在抓取时读取占用数与溢出数。
+    """
+    from sqlalchemy import event
+
+    checkouts = counter(
+        "clipbox_db_pool_checkouts_total",
+        "Connections checked out from the pool.",
+    )
+    pool = engine.pool
+
+    def _pool_value(name):
+        method = getattr(pool, name, None)
+        return method() if callable(method) else 0
+
+    gauge(
+        "clipbox_db_pool_checked_out",
+        "Connections currently checked out.",
+        collect=lambda: _pool_value("checkedout"),
+    )
+    gauge(
+        "clipbox_db_pool_overflow",
+        "Connections open beyond the pool size.",
+        collect=lambda: max(_pool_value("overflow"), 0),
+    )
+    gauge(
+        "clipbox_db_pool_size",
+        "Configured pool size.",
+        collect=lambda: _pool_value("size"),
+    )
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checkouts.inc()
+
+
+def _route_label(scope):
+    """
+    把实际路径中的路径参数还原为 {name}，使标签数量有限：
+    /clip/12345 -> /clip/{code}。
+    """
+    if scope.get("route") is None:
+        return "unmatched"
+    path = scope.get("path", "")
+    end = len(path)
+    # Parameters appear in path order; replace from the right so a value
+    # that also occurs earlier in the path is not matched by mistake
+    for name, value in reversed(list((scope.get("path_params") or {}).items())):
+        value = str(value)
+        index = path.rfind(value, 0, end) if value else -1
+        if index < 0:
+            continue
+        path = f"{path[:index]}{{{name}}}{path[index + len(value):]}"
+        end = index
+    return path
+
+
+class MetricsMiddleware:
+    """
+    ASGI 中间件：按路由模板记录请求耗时和收发字节数。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        received = 0
+        sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            route = _route_label(scope)
+            http_request_duration.observe(
+                time.perf_counter() - start, scope["method"], route, str(status)
+            )
+            if received:
+                http_request_bytes.inc(route, amount=received)
+            if sent:
+                http_response_bytes.inc(route, amount=sent)
@@ -0,0 +1,382 @@
+import os
+import sys
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    String,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+)
+from app.config import settings
+from app.database import (
+    STORAGE_BYTES_COUNTER,
+    Base,
+    Blob,
+    Clip,
+    Counter,
+    HashJob,
+    HashResult,
+    StorageReservation,
+    engine,
+)
+
+logger = logging.getLogger(__name__)
+
+_LOCK_NAME = "clipbox_schema_migrations"
+# Arbitrary constant shared by all workers for pg_advisory_lock
+_PG_LOCK_KEY = 0x434C4950
+
+
+class SchemaMigration(Base):
+    __tablename__ = "cb_schema_migrations"
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(100), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+
+def _column_exists(conn, table, column):
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def _add_column(conn, table, column_ddl, after=None):
+    sql = f"ALTER TABLE {table} ADD COLUMN {column_ddl}"
+    if after and conn.dialect.name == "mysql":
+        sql += f" AFTER {after}"
+    conn.execute(text(sql))
+
+
+def _column_ddl(conn, model, name):
+    column = model.__table__.c[name]
+    return f"{name} {column.type.compile(dialect=conn.dialect)} NULL"
+
+
+def _create_index(conn, table, name):
+    for index in table.indexes:
+        if index.name == name:
+            index.create(bind=conn, checkfirst=True)
+
+
+# Every migration must be idempotent: databases created before the ledger
+# existed already have some of these changes and replay all of them once
+
+
+def _create_tables():
+    # Creates only missing tables, so later models are picked up here too on
+    # a fresh database and their own migrations become no-ops
+    Base.metadata.create_all(bind=engine)
+
+
+def _add_client_ip():
+    with engine.begin() as conn:
+        if not _column_exists(conn, "cb_clips", "client_ip"):
+            _add_column(
+                conn, "cb_clips", "client_ip VARCHAR(45) NULL", after="mime_type"
+            )
+
+
+def _add_expires_at():
+    with engine.begin() as conn:
+        if not _column_exists(conn, "cb_clips", "expires_at"):
+            _add_column(
+                conn, "cb_clips", "expires_at DATETIME NULL", after="updated_at"
+            )
+        _create_index(conn, Clip.__table__, "ix_cb_clips_expires_at")
+
+
+def _backfill_expires_at():
+    if engine.dialect.name == "mysql":
+        backfill_sql = text("""
+            UPDATE cb_clips
+            SET expires_at = DATE_ADD(
+                COALESCE(created_at, '1970-01-01'),
+                INTERVAL expire_seconds SECOND
+            )
+            WHERE expires_at IS NULL
+            LIMIT :batch
+        """)
+    else:
+        backfill_sql = text("""
+            UPDATE cb_clips
+            SET expires_at = datetime(
+                COALESCE(created_at, '1970-01-01'),
+                '+' || expire_seconds || ' seconds'
+            )
+            WHERE id IN (
+                SELECT id FROM cb_clips WHERE expires_at IS NULL LIMIT :batch
+            )
+        """)
+
+    # Backfill in small batches so the table is never locked for long
+    backfilled = 0
+    while True:
+        with engine.begin() as conn:
+            updated = conn.execute(
+                backfill_sql, {"batch": settings.CLEANUP_BATCH_SIZE}
+            ).rowcount
+        backfilled += updated
+        if updated < settings.CLEANUP_BATCH_SIZE:
+            break
+    if backfilled:
+        logger.info(f"Backfilled expires_at for {backfilled} clips")
+
+
+def _import_blobs():
+    with engine.begin() as conn:
+        # Clips stored before the blob table share files by file_hash
+        imported = conn.execute(text("""
+                INSERT INTO cb_blobs
+                    (sha256, path, size, mime_type, refcount, verified, created_at)
+                SELECT c.file_hash, MIN(c.file_path), MAX(c.file_size),
+                       MAX(c.mime_type), COUNT(*), 0, MIN(c.created_at)
+                FROM cb_clips c
+                LEFT JOIN cb_blobs b ON b.sha256 = c.file_hash
+                WHERE c.content_type = 'file'
+                  AND c.file_hash IS NOT NULL
+                  AND c.file_path IS NOT NULL
+                  AND b.sha256 IS NULL
+                GROUP BY c.file_hash
+            """)).rowcount
+    if imported:
+        logger.info(f"Imported {imported} stored files into cb_blobs")
+
+
+def _add_bundle_content_type():
+    with engine.begin() as conn:
+        # Only MySQL stores the enum in the column type; elsewhere it is a string
+        if conn.dialect.name != "mysql":
+            return
+        content_type = next(
+            c
+            for c in inspect(conn).get_columns("cb_clips")
+            if c["name"] == "content_type"
+        )
+        if "bundle" not in getattr(content_type["type"], "enums", ()):
+            conn.execute(text("""
+                    ALTER TABLE cb_clips MODIFY COLUMN content_type
+                    ENUM('text/plain', 'link', 'file', 'bundle') NOT NULL
+                """))
+
+
+def _add_content_blob():
+    with engine.begin() as conn:
+        for column, after in (
+            ("content_blob", "content"),
+            ("content_encoding", "content_blob"),
+        ):
+            if not _column_exists(conn, "cb_clips", column):
+                _add_column(
+                    conn, "cb_clips", _column_ddl(conn, Clip, column), after=after
+                )
+
+
+def _count_storage_bytes():
+    with engine.begin() as conn:
+        exists = conn.execute(
+            select(Counter.name).where(Counter.name == STORAGE_BYTES_COUNTER)
+        ).first()
+        if exists:
+            return
+        total = conn.execute(select(func.coalesce(func.sum(Blob.size), 0))).scalar()
+        conn.execute(insert(Counter).values(name=STORAGE_BYTES_COUNTER, value=total))
+
+
+def _add_last_accessed_at():
+    with engine.begin() as conn:
+        if not _column_exists(conn, "cb_clips", "last_accessed_at"):
+            _add_column(
+                conn, "cb_clips", "last_accessed_at DATETIME NULL", after="expires_at"
+            )
+
+
+def _create_hash_tables():
+    for model in (HashJob, HashResult):
+        model.__table__.create(bind=engine, checkfirst=True)
+
+
+def _create_storage_reservations():
+    StorageReservation.__table__.create(bind=engine, checkfirst=True)
+
+
+# (version, name, apply); append only, never renumber or edit an applied entry
+MIGRATIONS = (
+    (1, "create tables", _create_tables),
+    (2, "add cb_clips.client_ip", _add_client_ip),
+    (3, "add cb_clips.expires_at", _add_expires_at),
+    (4, "backfill cb_clips.expires_at", _backfill_expires_at),
+    (5, "import legacy files into cb_blobs", _import_blobs),
+    (6, "add bundle content type", _add_bundle_content_type),
+    (7, "add cb_clips.content_blob", _add_content_blob),
+    (8, "count stored blob bytes", _count_storage_bytes),
+    (9, "add cb_clips.last_accessed_at", _add_last_accessed_at),
+    (10, "create hash job and result tables", _create_hash_tables),
+    (11, "create cb_storage_reservations", _create_storage_reservations),
+)
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _lock_path():
+    database = engine.url.database
+    if not database or database == ":memory:":
+        return None
+    return os.path.abspath(database) + ".migrate.lock"
+
+
+@contextmanager
+def _file_lock(path):
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            f.seek(0)
+            # LK_LOCK retries for about ten seconds; keep trying past that
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def migration_lock():
+    """
+    在所有进程之间互斥的迁移锁：MySQL 使用 GET_LOCK，PostgreSQL 使用会话级
+    advisory lock，SQLite 使用数据库文件旁的文件锁。
+    """
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        path = _lock_path()
+        if path is None:
+            yield
+            return
+        with _file_lock(path):
+            yield
+        return
+
+    # The lock belongs to this connection's session, so hold it throughout
+    with engine.connect() as conn:
+        if dialect == "mysql":
+            acquired = conn.execute(
+                text("SELECT GET_LOCK(:name, :timeout)"),
+                {"name": _LOCK_NAME, "timeout": settings.MIGRATION_LOCK_TIMEOUT},
+            ).scalar()
+            if acquired != 1:
+                raise RuntimeError("Timed out waiting for the migration lock")
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": _LOCK_NAME})
+        elif dialect == "postgresql":
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _PG_LOCK_KEY})
+            try:
+                yield
+            finally:
+                conn.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": _PG_LOCK_KEY}
+                )
+        else:
+            yield
+
+
+def current_version():
+    """
+    返回已应用的最高迁移版本，尚无迁移记录表时返回 0。
+    """
+    with engine.connect() as conn:
+        if not inspect(conn).has_table(SchemaMigration.__tablename__):
+            return 0
+        version = conn.execute(
+            select(SchemaMigration.version)
+            .order_by(SchemaMigration.version.desc())
+            .limit(1)
+        ).scalar()
+    return version or 0
+
+
+def migrate():
+    """
+    持有迁移锁按版本顺序执行尚未应用的迁移，每条成功后写入 cb_schema_migrations。
+    等锁期间其他进程可能已经完成迁移，拿到锁后重新读取已应用版本。
+    返回本次应用的迁移数量。
+    """
+    with migration_lock():
+        SchemaMigration.__table__.create(bind=engine, checkfirst=True)
+        with engine.connect() as conn:
+            applied = set(conn.execute(select(SchemaMigration.version)).scalars())
+
+        count = 0
+        for version, name, apply in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version}: {name}")
+            apply()
+            with engine.begin() as conn:
+                conn.execute(
+                    SchemaMigration.__table__.insert().values(
+                        version=version, name=name, applied_at=datetime.utcnow()
+                    )
+                )
+            count += 1
+    return count
+
+
+def ensure_schema():
+    """
+    worker 启动时调用：结构已是最新版本时只读取一次版本号。
+    落后时若开启 SCHEMA_AUTO_MIGRATE 则竞争迁移锁执行迁移，否则拒绝启动。
+    """
+    version = current_version()
+    if version == LATEST_VERSION:
+        return
+    if version > LATEST_VERSION:
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this code "
+            f"({LATEST_VERSION})"
+        )
+    if not settings.SCHEMA_AUTO_MIGRATE:
+        raise RuntimeError(
+            f"Database schema version {version} is behind {LATEST_VERSION}, "
+            f"run `python -m app.migrations` first"
+        )
+    applied = migrate()
+    if applied:
+        logger.info(f"Database schema migrated to version {LATEST_VERSION}")
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    if argv[1:] == ["status"]:
+        print(f"version {current_version()} of {LATEST_VERSION}")
+        return 0
+    if argv[1:]:
+        print("usage: python -m app.migrations [status]")
+        return 2
+    applied = migrate()
+    print(f"Applied {applied} migrations, schema is at version {LATEST_VERSION}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import re
+import threading
+import time
+import logging
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from app.config import settings
+from app.database import RateBucket, engine
+from app.metrics import rate_limited, upload_in_flight_bytes
+from app.utils import get_real_ip
+
+logger = logging.getLogger(__name__)
+
+# Buckets idle this long are full again and can be forgotten
+_IDLE_SECONDS = 3600
+
+
+class MemoryBackend:
+    """
+    进程内令牌桶，多个 worker 之间不共享。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._takes = 0
+
+    def take(self, key, cost, rate, capacity):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens < cost:
+                self._buckets[key] = (tokens, now)
+                return False, (cost - tokens) / rate
+            self._buckets[key] = (tokens - cost, now)
+
+            self._takes += 1
+            if self._takes % 10000 == 0:
+                self._prune(now)
+        return True, 0.0
+
+    def _prune(self, now):
+        idle = [k for k, (_, t) in self._buckets.items() if now - t > _IDLE_SECONDS]
+        for key in idle:
+            del self._buckets[key]
+
+    def prune(self):
+        with self._lock:
+            self._prune(time.monotonic())
+
+
+class DatabaseBackend:
+    """
+    保存在 cb_rate_buckets 中的令牌桶，所有 worker 共享。
+    用条件 UPDATE 做乐观并发控制，冲突时重试。
+    """
+
+    def take(self, key, cost, rate, capacity):
+        for _ in range(5):
+            now = time.time()
+            with engine.begin() as conn:
+                row = conn.execute(
+                    select(RateBucket.tokens, RateBucket.updated_at).where(
+                        RateBucket.key == key
+                    )
+                ).first()
+                if row is not None:
+                    tokens = min(
+                        capacity, row.tokens + max(now - row.updated_at, 0) * rate
+                    )
+                    if tokens < cost:
+                        return False, (cost - tokens) / rate
+                    updated = conn.execute(
+                        update(RateBucket)
+                        .where(
+                            RateBucket.key == key,
+                            RateBucket.updated_at == row.updated_at,
+                        )
+                        .values(tokens=tokens - cost, updated_at=now)
+                    ).rowcount
+                    if updated:
+                        return True, 0.0
+                    continue
+            try:
+                with engine.begin() as conn:
+                    conn.execute(
+                        insert(RateBucket).values(
+                            key=key, tokens=capacity - cost, updated_at=now
+                        )
+                    )
+                return True, 0.0
+            except IntegrityError:
+                continue
+        # Heavy contention on one key is itself a sign of abuse
+        return False, 1.0
+
+    def prune(self):
+        with engine.begin() as conn:
+            conn.execute(
+                delete(RateBucket).where(
+                    RateBucket.updated_at < time.time() - _IDLE_SECONDS
+                )
+            )
+
+
+class AdmissionGate:
+    """
+    限制整个进程同时在传输中的上传字节数。
+    超出预算的请求排队等待，超时后拒绝；单个超过预算的请求在空闲时仍可进入。
+    """
+
+    def __init__(self):
+        self._in_flight = 0
+        self._cond = None
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def _fits(self, amount):
+        return (
+            self._in_flight == 0
+            or self._in_flight + amount <= settings.UPLOAD_INFLIGHT_BYTES
+        )
+
+    async def acquire(self, amount, timeout):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._fits(amount)), timeout
+                )
+            except asyncio.TimeoutError:
+                return False
+            self._in_flight += amount
+            upload_in_flight_bytes.set(self._in_flight)
+            return True
+
+    async def release(self, amount):
+        async with self._cond:
+            self._in_flight -= amount
+            upload_in_flight_bytes.set(self._in_flight)
+            self._cond.notify_all()
+
+
+def _create_backend():
+    if settings.RATE_LIMIT_BACKEND == "database":
+        return DatabaseBackend()
+    return MemoryBackend()
+
+
+backend = _create_backend()
+upload_gate = AdmissionGate()
+
+# (method, path pattern, counts against the request budget, carries upload bytes)
+_RULES = (
+    ("POST", re.compile(r"^/clip/create$"), True, False),
+    ("POST", re.compile(r"^/clip/create/batch$"), True, True),
+    ("POST", re.compile(r"^/clip/upload/prepare$"), True, False),
+    ("POST", re.compile(r"^/clip/upload/session$"), True, False),
+    ("POST", re.compile(r"^/clip/upload$"), True, True),
+    ("POST", re.compile(r"^/clip/upload/bundle$"), True, True),
+    ("PUT", re.compile(r"^/clip/upload/raw$"), True, True),
+    ("PUT", re.compile(r"^/clip/upload/session/[0-9a-f]+/\d+$"), False, True),
+)
+
+
+def _match_rule(method, path):
+    for rule_method, pattern, requests, upload in _RULES:
+        if method == rule_method and pattern.match(path):
+            return requests, upload
+    return None
+
+
+async def _take(key, cost, per_minute, burst):
+    rate = per_minute / 60
+    # A single request larger than the bucket could otherwise never pass
+    cost = min(cost, burst)
+    if isinstance(backend, DatabaseBackend):
+        return await run_in_threadpool(backend.take, key, cost, rate, burst)
+    return backend.take(key, cost, rate, burst)
+
+
+# Uploads without Content-Length are charged in steps of this many bytes
+_METER_STEP = 1024 * 1024
+
+
+class _Rejected(BaseException):
+    """
+    读取请求体途中超出限额。继承 BaseException，避免应用内解析请求体的
+    except Exception 把它变成 400，由中间件捕获后返回 429/503。
+    """
+
+    def __init__(self, status, error, retry_after):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+        self.retry_after = retry_after
+
+
+async def _admit_bytes(client_ip, amount):
+    """
+    从该 IP 的字节令牌桶扣除 amount 并占用准入额度，失败时抛出 _Rejected。
+    """
+    allowed, retry_after = await _take(
+        f"bytes:{client_ip}",
+        amount,
+        settings.RATE_LIMIT_BYTES_PER_MINUTE,
+        settings.RATE_LIMIT_BYTE_BURST,
+    )
+    if not allowed:
+        rate_limited.inc("bytes")
+        raise _Rejected(429, "Upload rate limit exceeded", retry_after)
+
+    if not await upload_gate.acquire(amount, settings.UPLOAD_ADMISSION_TIMEOUT):
+        rate_limited.inc("admission")
+        raise _Rejected(503, "Server busy", settings.UPLOAD_ADMISSION_TIMEOUT)
+
+
+async def _reject(send, status, error, retry_after):
+    body = json.dumps({"error": error}).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, int(retry_after + 0.999))).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """
+    按真实 IP 的令牌桶限制写接口的请求数和上传字节数，并对上传做全局准入控制。
+    请求数在调用接口前扣除；上传字节随请求体读取分步扣除，秒传命中等
+    不读取请求体的请求不计费，超出限额时在写入更多数据前拒绝。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        rule = _match_rule(scope["method"], scope["path"])
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        counts_request, carries_upload = rule
+        client_ip = get_real_ip(Request(scope)) or "unknown"
+
+        if counts_request:
+            allowed, retry_after = await _take(
+                f"req:{client_ip}",
+                1,
+                settings.RATE_LIMIT_REQUESTS_PER_MINUTE,
+                settings.RATE_LIMIT_REQUEST_BURST,
+            )
+            if not allowed:
+                rate_limited.inc("requests")
+                await _reject(send, 429, "Too many requests", retry_after)
+                return
+
+        if not carries_upload:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        try:
+            upload_bytes = int(headers[b"content-length"])
+        except (KeyError, ValueError):
+            upload_bytes = None
+
+        admitted = 0
+        received = 0
+        response_started = False
+
+        async def metered_receive():
+            # Charge the body as it is read: a handler that answers without
+            # reading it, like an instant upload, is not billed for the file
+            nonlocal admitted, received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > admitted:
+                    step = max(_METER_STEP, received - admitted)
+                    if upload_bytes is not None:
+                        # Never charge past the declared length
+                        step = max(
+                            min(step, upload_bytes - admitted), received - admitted
+                        )
+                    await _admit_bytes(client_ip, step)
+                    admitted += step
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, metered_receive, tracking_send)
+        except _Rejected as e:
+            if not response_started:
+                await _reject(send, e.status, e.error, e.retry_after)
+        finally:
+            if admitted:
+                await upload_gate.release(admitted)
@@ -0,0 +1,247 @@
+import os
+import shutil
+import time
+import logging
+from app.config import settings
+from app.database import (
+    Blob,
+    Clip,
+    UploadSession,
+    UPLOAD_SESSION_DIR,
+    get_state,
+    set_state,
+)
+from app.storage import BLOB_DIR, TMP_DIR
+from app.metrics import cleanup_duration, cleanup_removed
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = "orphan_reconcile"
+
+# Keep IN (...) lists well below driver and server limits
+_QUERY_CHUNK = 500
+
+
+def _sorted_dirs(path):
+    try:
+        return sorted(e.name for e in os.scandir(path) if e.is_dir())
+    except OSError:
+        return []
+
+
+def _iter_shards(cursor):
+    """
+    按固定顺序产出 (key, path, kind)，key 的字典序与产出顺序一致，
+    以便从持久化的 cursor 之后继续。
+    """
+    for ab in _sorted_dirs(BLOB_DIR):
+        # "zz" sorts after every hex shard name, so this skips the whole prefix
+        if cursor and f"blobs/{ab}/zz" <= cursor:
+            continue
+        for cd in _sorted_dirs(os.path.join(BLOB_DIR, ab)):
+            key = f"blobs/{ab}/{cd}"
+            if cursor and key <= cursor:
+                continue
+            yield key, os.path.join(BLOB_DIR, ab, cd), "blob"
+
+    # Per-day directories written before the blob store
+    for name in _sorted_dirs(settings.DATA_DIR):
+        if name.startswith(".") or os.path.join(settings.DATA_DIR, name) == BLOB_DIR:
+            continue
+        key = f"legacy/{name}"
+        if cursor and key <= cursor:
+            continue
+        yield key, os.path.join(settings.DATA_DIR, name), "legacy"
+
+    for key, path, kind in (
+        ("tmp", TMP_DIR, "tmp"),
+        ("uploads", UPLOAD_SESSION_DIR, "uploads"),
+    ):
+        if cursor and key <= cursor:
+            continue
+        yield key, path, kind
+
+
+def _chunks(items):
+    for i in range(0, len(items), _QUERY_CHUNK):
+        yield items[i : i + _QUERY_CHUNK]
+
+
+def _is_stale(entry, now):
+    try:
+        return now - entry.stat().st_mtime > settings.ORPHAN_GRACE_SECONDS
+    except OSError:
+        return False
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+        return 1
+    except OSError as e:
+        logger.warning(f"Delete orphaned file failed {path}: {e}")
+        return 0
+
+
+def _remove_if_empty(path):
+    try:
+        os.rmdir(path)
+        return 1
+    except OSError:
+        return 0
+
+
+def _scan_blob_shard(db, path, now):
+    entries = [e for e in os.scandir(path) if e.is_file()]
+    known = set()
+    for names in _chunks([e.name for e in entries]):
+        known.update(
+            sha for (sha,) in db.query(Blob.sha256).filter(Blob.sha256.in_(names))
+        )
+
+    removed_files = 0
+    for entry in entries:
+        # Young files may belong to a blob row that is not committed yet
+        if entry.name not in known and _is_stale(entry, now):
+            removed_files += _remove_file(entry.path)
+
+    removed_dirs = 0
+    if _remove_if_empty(path):
+        removed_dirs = 1 + _remove_if_empty(os.path.dirname(path))
+    return removed_files, removed_dirs
+
+
+def _scan_legacy_dir(db, path, now):
+    entries = [e for e in os.scandir(path) if e.is_file()]
+    paths = [os.path.join(path, e.name) for e in entries]
+    known = set()
+    for chunk in _chunks(paths):
+        known.update(p for (p,) in db.query(Blob.path).filter(Blob.path.in_(chunk)))
+        known.update(
+            p for (p,) in db.query(Clip.file_path).filter(Clip.file_path.in_(chunk))
+        )
+    known = {os.path.normpath(p) for p in known}
+
+    removed_files = 0
+    for entry, file_path in zip(entries, paths):
+        if os.path.normpath(file_path) not in known and _is_stale(entry, now):
+            removed_files += _remove_file(file_path)
+
+    return removed_files, _remove_if_empty(path)
+
+
+def _scan_tmp_dir(db, path, now):
+    removed_files = 0
+    for entry in os.scandir(path):
+        if entry.is_file() and _is_stale(entry, now):
+            removed_files += _remove_file(entry.path)
+    return removed_files, 0
+
+
+def _scan_upload_sessions(db, path, now):
+    entries = [e for e in os.scandir(path) if e.is_dir()]
+    known = set()
+    for ids in _chunks([e.name for e in entries]):
+        known.update(
+            sid
+            for (sid,) in db.query(UploadSession.id).filter(UploadSession.id.in_(ids))
+        )
+
+    removed_dirs = 0
+    for entry in entries:
+        if entry.name not in known and _is_stale(entry, now):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed_dirs += 1
+    return 0, removed_dirs
+
+
+_SCANNERS = {
+    "blob": _scan_blob_shard,
+    "legacy": _scan_legacy_dir,
+    "tmp": _scan_tmp_dir,
+    "uploads": _scan_upload_sessions,
+}
+
+
+def reconcile_storage(db, budget_seconds=None):
+    """
+    增量清理磁盘上没有数据库引用的文件。
+    只检查自上次完整巡检以来有变动的分片目录，按时间预算分批执行，
+    进度保存在 cb_app_state 中，下次调用从 cursor 继续。
+    """
+    if budget_seconds is None:
+        budget_seconds = settings.ORPHAN_SCAN_BUDGET_SECONDS
+    deadline = time.monotonic() + budget_seconds
+    started = time.perf_counter()
+    now = time.time()
+
+    progress = {
+        "checked": 0,
+        "skipped": 0,
+        "removed_files": 0,
+        "removed_dirs": 0,
+        "complete": False,
+        "full_sweep": False,
+        "cursor": None,
+    }
+    if not os.path.exists(settings.DATA_DIR):
+        progress["complete"] = True
+        return progress
+
+    try:
+        state = get_state(db, STATE_KEY, {})
+        cursor = state.get("cursor")
+        if not cursor:
+            state["pass_started"] = now
+            state["full_sweep"] = (
+                now - state.get("last_full_sweep", 0)
+                >= settings.ORPHAN_FULL_SWEEP_INTERVAL
+            )
+        # Directory mtimes change whenever an entry is added or removed
+        since = 0
+        if not state["full_sweep"]:
+            since = state.get("last_pass_started", 0) - settings.ORPHAN_GRACE_SECONDS
+
+        complete = True
+        for key, path, kind in _iter_shards(cursor):
+            if time.monotonic() >= deadline:
+                complete = False
+                break
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                cursor = key
+                continue
+            if kind in ("blob", "legacy") and mtime < since:
+                progress["skipped"] += 1
+            else:
+                removed_files, removed_dirs = _SCANNERS[kind](db, path, now)
+                progress["checked"] += 1
+                progress["removed_files"] += removed_files
+                progress["removed_dirs"] += removed_dirs
+            cursor = key
+
+        if complete:
+            state["last_pass_started"] = state["pass_started"]
+            if state["full_sweep"]:
+                state["last_full_sweep"] = state["pass_started"]
+            state["cursor"] = None
+        else:
+            state["cursor"] = cursor
+
+        set_state(db, STATE_KEY, state)
+        db.commit()
+
+        progress["complete"] = complete
+        progress["full_sweep"] = state["full_sweep"]
+        progress["cursor"] = state["cursor"]
+        return progress
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Reconcile storage failed: {e}")
+        return progress
+    finally:
+        cleanup_duration.observe(time.perf_counter() - started, "orphans")
+        cleanup_removed.inc(
+            "orphans", amount=progress["removed_files"] + progress["removed_dirs"]
+        )
@@ -1,5 +1,7 @@
 from fastapi import APIRouter
 from .clip import router as clip_router
+from .metrics import router as metrics_router
 
 api_router = APIRouter()
 api_router.include_router(clip_router, prefix="/clip", tags=["clip"])
+api_router.include_router(metrics_router, tags=["metrics"])
@@ -5,77 +5,259 @@ from fastapi import (
     Form,
     UploadFile,
     File,
-    BackgroundTasks,
+    Body,
     Response,
 )
-from fastapi.responses import JSONResponse, RedirectResponse, FileResponse
+from fastapi.responses import (
+    JSONResponse,
+    RedirectResponse,
+    FileResponse,
+    StreamingResponse,
+)
+from pydantic import BaseModel
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
-from app.database import Clip, get_db, cleanup_expired_clips
-import random
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from app.database import (
+    Clip,
+    ClipFile,
+    Blob,
+    UploadSession,
+    get_db,
+    consume_access,
+    cleanup_expired_clips,
+    cleanup_expired_upload_sessions,
+    upload_session_dir,
+)
 import validators
 import hashlib
+import hmac
 import os
 import mimetypes
-import glob
-from datetime import datetime
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List
 from urllib.parse import quote
-from app.utils import get_real_ip
+from app.utils import accepts_encoding, get_real_ip
+from app.compression import compress_text, decompress_text
+from app.archive import stream_zip
+from app.budget import Reservation, StorageFull, reserve_space, status as storage_status
+from app.reconcile import reconcile_storage
+from app.codes import allocate_code, code_allocator, secret_key
+from app.cache import clip_cache
 from app.config import settings
+from app.scheduler import expiry_scheduler
+from app.metrics import (
+    instant_upload,
+    upload_bytes,
+)
+from app.storage import (
+    COPY_CHUNK_SIZE,
+    FileTooLarge,
+    save_chunks,
+    save_stream,
+    temp_upload_path,
+    find_blob,
+    acquire_blob,
+    claim_blob,
+    release_blob_claim,
+    wait_for_blob,
+    store_blob,
+    delete_clip,
+)
 
 router = APIRouter()
 
 
-def cleanup_orphaned_files(db: Session):
-    orphaned_count = 0
-    data_dir = "data"
-    if not os.path.exists(data_dir):
-        return orphaned_count
+def _is_valid_sha256(h: str) -> bool:
+    return len(h) == 64 and all(c in "0123456789abcdef" for c in h)
+
+
+def _find_or_claim_blob(db: Session, digest: str, owner: str, size=None):
+    """
+    查找已存储的 blob；不存在时为 owner 声明写入，返回 (blob, claimed)。
+    其他请求已声明同一摘要时等待其写完，超时返回 (None, False)。
+    """
+    blob = find_blob(db, digest, size)
+    if blob:
+        return blob, False
+    # Single flight: the first upload of a digest writes the blob,
+    # concurrent ones wait for it and attach instead
+    if claim_blob(digest, owner):
+        return None, True
+    return wait_for_blob(db, digest, size), False
 
+
+def _schedule_expiry(expire: int):
+    # Commit expired the instance; the stored value is at most this late
+    expiry_scheduler.schedule(datetime.utcnow() + timedelta(seconds=expire))
+
+
+def _create_instant_clip(
+    db: Session,
+    blob: Blob,
+    code: str,
+    filename: str,
+    client_ip,
+    count: int,
+    expire: int,
+):
+    """
+    引用已存储的 blob 创建文件剪贴板，不写入任何数据。
+    blob 在此期间被删除时返回 None，调用方按未命中处理。
+    """
+    mime_type, _ = mimetypes.guess_type(filename)
+    new_clip = Clip(
+        code=code,
+        content_type="file",
+        filename=filename,
+        file_path=blob.path,
+        file_hash=blob.sha256,
+        file_size=blob.size,
+        mime_type=blob.mime_type or mime_type or "application/octet-stream",
+        client_ip=client_ip,
+        access_count=count,
+        max_count=count,
+        expire_seconds=expire,
+    )
     try:
-        valid_file_paths = set()
-        active_clips = db.query(Clip).filter(Clip.content_type == "file").all()
+        if not acquire_blob(db, blob.sha256):
+            db.rollback()
+            return None
+        db.add(new_clip)
+        db.commit()
+    except Exception:
+        db.rollback()
+        return JSONResponse({"error": "Database error"}, status_code=500)
+    _schedule_expiry(expire)
+    instant_upload.inc("hit")
+    return {"code": code, "instant_upload": True}
+
+
+def _register_uploaded_file(
+    db: Session,
+    code: str,
+    original_filename: str,
+    tmp_path: str,
+    file_size: int,
+    file_hash: str,
+    client_hash,
+    client_ip,
+    count: int,
+    expire: int,
+):
+    def _discard(path):
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-        for clip in active_clips:
-            if clip.file_path and not clip.is_expired():
-                valid_file_paths.add(os.path.normpath(clip.file_path))
+    if client_hash and client_hash != file_hash:
+        _discard(tmp_path)
+        return JSONResponse({"error": "File hash mismatch"}, status_code=400)
 
-        pattern = os.path.join(data_dir, "*", "*")
-        disk_files = glob.glob(pattern)
+    mime_type, _ = mimetypes.guess_type(original_filename)
+    if not mime_type:
+        mime_type = "application/octet-stream"
 
-        for file_path in disk_files:
-            if os.path.isdir(file_path):
-                continue
-            normalized_path = os.path.normpath(file_path)
-            if normalized_path not in valid_file_paths:
-                try:
-                    os.remove(file_path)
-                    orphaned_count += 1
-                except OSError as e:
-                    pass
+    file_path = None
+    created = False
+    try:
+        # Same content already stored: keep a single copy on disk
+        file_path, created = store_blob(db, tmp_path, file_hash, file_size, mime_type)
+        clip = Clip(
+            code=code,
+            content_type="file",
+            filename=original_filename,
+            file_path=file_path,
+            file_hash=file_hash,
+            file_size=file_size,
+            mime_type=mime_type,
+            client_ip=client_ip,
+            access_count=count,
+            max_count=count,
+            expire_seconds=expire,
+        )
+        db.add(clip)
+        db.commit()
+    except Exception:
+        db.rollback()
+        _discard(tmp_path)
+        if created:
+            _discard(file_path)
+        return JSONResponse({"error": "Database error"}, status_code=500)
+
+    _schedule_expiry(expire)
+    upload_bytes.inc("stored" if created else "deduplicated", amount=file_size)
+    if client_hash:
+        return {"code": code, "instant_upload": False}
+    return {"code": code}
 
-        return orphaned_count
-    except Exception as e:
-        return 0
 
+def _validate_clip_content(content: str, is_link: bool):
+    """
+    校验文本或链接内容，返回 (raw, error)。
+    raw 为文本的 UTF-8 编码（链接为 None），error 为错误信息或 None。
+    """
+    if not content:
+        return None, "Missing content"
+
+    if is_link:
+        if not validators.url(content):
+            return None, "Content must be a valid URL when link=yes"
+        if len(content) > settings.MAX_LINK_LENGTH:
+            return None, "Link is too long"
+        return None, None
+
+    raw = content.encode("utf-8")
+    if len(raw) > settings.MAX_TEXT_SIZE:
+        return None, "Text content too large"
+    return raw, None
+
+
+def _inline_text_fields(content: str, raw):
+    # Links and small text stay as-is, larger text is stored compressed
+    compressed = compress_text(content) if raw is not None else None
+    if compressed:
+        content_encoding, content_blob = compressed
+        return {
+            "content": None,
+            "content_blob": content_blob,
+            "content_encoding": content_encoding,
+        }
+    return {"content": content, "content_blob": None, "content_encoding": None}
 
-def cleanup_empty_directories(base_dir: str = "data") -> int:
-    removed_count = 0
-    if not os.path.exists(base_dir):
-        return removed_count
 
+def _spill_text_fields(db: Session, raw: bytes):
+    """
+    把大文本写入 blob 存储，返回 (fields, created_path)。
+    调用方提交事务，回滚时需删除 created_path。
+    """
+    tmp_path = temp_upload_path()
     try:
-        for root, dirs, files in os.walk(base_dir, topdown=False):
-            if os.path.normpath(root) == os.path.normpath(base_dir):
-                continue
-            try:
-                if not os.listdir(root):
-                    os.rmdir(root)
-                    removed_count += 1
-            except OSError as e:
-                pass
-        return removed_count
-    except Exception as e:
-        return 0
+        file_size, file_hash = save_chunks([raw], tmp_path)
+        file_path, created = store_blob(
+            db, tmp_path, file_hash, file_size, "text/plain"
+        )
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fields = {
+        "content": None,
+        "file_path": file_path,
+        "file_hash": file_hash,
+        "file_size": file_size,
+    }
+    return fields, file_path if created else None
+
+
+def _is_spilled(raw):
+    return raw is not None and len(raw) >= settings.TEXT_SPILL_MIN_SIZE
 
 
 @router.post("/create")
@@ -90,133 +272,538 @@ def create_clip(
     is_link = link.lower() == "yes"
     content = content.strip()
 
-    if not content:
-        return JSONResponse({"error": "Missing content"}, status_code=400)
-
-    if is_link and not validators.url(content):
-        return JSONResponse(
-            {"error": "Content must be a valid URL when link=yes"}, status_code=400
-        )
-
-    if is_link and len(content) > settings.MAX_LINK_LENGTH:
-        return JSONResponse({"error": "Link is too long"}, status_code=400)
-
-    if not is_link:
-        if len(content.encode("utf-8")) > settings.MAX_TEXT_SIZE:
-            return JSONResponse({"error": "Text content too large"}, status_code=400)
+    raw, error = _validate_clip_content(content, is_link)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
 
     content_type = "link" if is_link else "text/plain"
 
-    while True:
-        code = str(random.randint(10000, 99999))
-        if not db.query(Clip).filter_by(code=code).first():
-            break
+    code = allocate_code()
 
     client_ip = get_real_ip(request)
 
-    clip = Clip(
-        code=code,
-        content_type=content_type,
-        content=content,
-        client_ip=client_ip,
-        access_count=count,
-        max_count=count,
-        expire_seconds=expire,
-    )
+    spilled = _is_spilled(raw)
+    reservation = None
+    if spilled:
+        reservation = reserve_space(len(raw))
+        if reservation is None:
+            return _insufficient_storage()
 
+    created_path = None
     try:
+        if spilled:
+            # Large text lives in the blob store, the row keeps a reference
+            fields, created_path = _spill_text_fields(db, raw)
+        else:
+            fields = _inline_text_fields(content, raw)
+
+        clip = Clip(
+            code=code,
+            content_type=content_type,
+            client_ip=client_ip,
+            access_count=count,
+            max_count=count,
+            expire_seconds=expire,
+            **fields,
+        )
         db.add(clip)
         db.commit()
+        _schedule_expiry(expire)
         return {"code": code}
     except Exception as e:
         db.rollback()
+        if created_path and os.path.exists(created_path):
+            os.remove(created_path)
         return JSONResponse({"error": "Database error"}, status_code=500)
+    finally:
+        if reservation is not None:
+            reservation.release()
+
+
+class ClipSpec(BaseModel):
+    content: str = ""
+    link: bool = False
+    count: int = 1
+    expire: int = 3600
+
+
+@router.post("/create/batch")
+def create_clips_batch(
+    request: Request,
+    specs: List[ClipSpec] = Body(...),
+    db: Session = Depends(get_db),
+):
+    if not specs:
+        return JSONResponse({"error": "Missing clips"}, status_code=400)
+    if len(specs) > settings.MAX_BATCH_SIZE:
+        return JSONResponse(
+            {"error": f"At most {settings.MAX_BATCH_SIZE} clips per batch"},
+            status_code=400,
+        )
+    # The rate limiter has already charged the body's bytes; this bounds
+    # how much a single batch may write
+    total_size = sum(len(spec.content.encode("utf-8")) for spec in specs)
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit():
+        total_size = max(total_size, int(content_length))
+    if total_size > settings.MAX_BATCH_BYTES:
+        return JSONResponse({"error": "Batch too large"}, status_code=413)
+
+    results = []
+    valid = []
+    for spec in specs:
+        content = spec.content.strip()
+        raw, error = _validate_clip_content(content, spec.link)
+        if error:
+            results.append({"error": error})
+        else:
+            results.append(None)
+            valid.append((len(results) - 1, spec, content, raw))
+
+    if not valid:
+        return {"created": 0, "results": results}
+
+    spilled_size = sum(len(raw) for _, _, _, raw in valid if _is_spilled(raw))
+    reservation = None
+    if spilled_size:
+        reservation = reserve_space(spilled_size)
+        if reservation is None:
+            return _insufficient_storage()
+
+    try:
+        return _insert_batch(request, db, valid, results)
+    finally:
+        if reservation is not None:
+            reservation.release()
+
+
+def _insert_batch(request: Request, db: Session, valid, results):
+    codes = code_allocator.allocate_many(len(valid))
+    client_ip = get_real_ip(request)
+    now = datetime.utcnow()
+
+    rows = []
+    created_paths = []
+    try:
+        for (index, spec, content, raw), code in zip(valid, codes):
+            if _is_spilled(raw):
+                fields, created_path = _spill_text_fields(db, raw)
+                if created_path:
+                    created_paths.append(created_path)
+            else:
+                fields = _inline_text_fields(content, raw)
+            rows.append(
+                {
+                    "code": code,
+                    "content_type": "link" if spec.link else "text/plain",
+                    "content": fields["content"],
+                    "content_blob": fields.get("content_blob"),
+                    "content_encoding": fields.get("content_encoding"),
+                    "file_path": fields.get("file_path"),
+                    "file_hash": fields.get("file_hash"),
+                    "file_size": fields.get("file_size"),
+                    "client_ip": client_ip,
+                    "access_count": spec.count,
+                    "max_count": spec.count,
+                    "expire_seconds": spec.expire,
+                    "created_at": now,
+                    "updated_at": now,
+                    "expires_at": now + timedelta(seconds=spec.expire),
+                }
+            )
+        # One multi-row INSERT and one commit for the whole batch
+        db.execute(insert(Clip), rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        for path in created_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        return JSONResponse({"error": "Database error"}, status_code=500)
+
+    for (index, spec, _, _), code in zip(valid, codes):
+        results[index] = {"code": code}
+    for expire in {spec.expire for _, spec, _, _ in valid}:
+        _schedule_expiry(expire)
+    return {"created": len(valid), "results": results}
+
+
+def _text_clip_response(request: Request, content, content_type, content_encoding):
+    if content_type == "link":
+        return RedirectResponse(url=content, status_code=302)
+
+    media_type = (
+        f"{content_type}; charset=utf-8"
+        if content_type != "text/plain"
+        else "text/plain; charset=utf-8"
+    )
+    if not content_encoding:
+        return Response(content=content, media_type=media_type)
+
+    # Stored compressed: pass the stream through when the client accepts it
+    if accepts_encoding(request, content_encoding):
+        return Response(
+            content=content,
+            media_type=media_type,
+            headers={"Content-Encoding": content_encoding, "Vary": "Accept-Encoding"},
+        )
+    return Response(
+        content=decompress_text(content_encoding, content),
+        media_type=media_type,
+        headers={"Vary": "Accept-Encoding"},
+    )
+
+
+@router.get("/timetask_cleanup_files")
+def timetask_cleanup_files(db: Session = Depends(get_db)):
+    try:
+        expired_count = cleanup_expired_clips(db)
+        session_count = cleanup_expired_upload_sessions(db)
+        progress = reconcile_storage(db)
+        orphaned_count = progress["removed_files"]
+        empty_dir_count = progress["removed_dirs"]
+        return {
+            "expired": expired_count,
+            "orphaned_files": orphaned_count,
+            "empty_dirs": empty_dir_count,
+            "upload_sessions": session_count,
+            "reconcile": progress,
+            "message": f"Cleaned {expired_count} expired, {orphaned_count} orphaned files, {empty_dir_count} empty dirs",
+        }
+    except Exception as e:
+        return JSONResponse({"error": f"Cleanup failed: {str(e)}"}, status_code=500)
+
+
+@router.get("/storage/status")
+def get_storage_status():
+    return storage_status()
+
+
+def _insufficient_storage():
+    return JSONResponse({"error": "Insufficient storage"}, status_code=507)
+
+
+def _file_etag(clip: Clip):
+    # Content-addressed, so the digest is a strong validator
+    return f'"{clip.file_hash}"' if clip.file_hash else None
+
+
+def _is_continuation_range(range_header):
+    """
+    Range 请求的所有区间都从 0 之后的明确位置开始时，视为续传或拖动。
+    后缀区间（"-500"）可以取到整个文件，不算续传。
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return False
+    for spec in range_header[len("bytes=") :].split(","):
+        start = spec.strip().split("-", 1)[0].strip()
+        if not start.isdigit() or int(start) == 0:
+            return False
+    return True
+
+
+def _resume_etag(clip: Clip, issued=None):
+    """
+    每次计费下载签发的 ETag：内容摘要、签发时间和对二者与取件码的签名。
+    续传时在 If-Range 中带回，证明这段区间属于一次已计费的下载。
+    """
+    if not clip.file_hash:
+        return None
+    if issued is None:
+        issued = int(time.time())
+    signature = hashlib.blake2b(
+        f"{clip.code}:{clip.file_hash}:{issued}".encode(),
+        key=secret_key("resume"),
+        digest_size=16,
+    ).hexdigest()
+    return f'"{clip.file_hash}.{issued:x}.{signature}"'
+
+
+def _valid_resume_etag(clip: Clip, header_value):
+    # Only a strong validator we signed for this clip, within the grace period
+    if not header_value or not clip.file_hash:
+        return None
+    value = header_value.strip()
+    parts = value.strip('"').split(".")
+    if len(parts) != 3 or parts[0] != clip.file_hash:
+        return None
+    try:
+        issued = int(parts[1], 16)
+    except ValueError:
+        return None
+    if not 0 <= time.time() - issued <= settings.FILE_RESUME_GRACE_SECONDS:
+        return None
+    expected = _resume_etag(clip, issued)
+    return expected if hmac.compare_digest(expected, value) else None
+
+
+def _etag_digest(value):
+    # Content digest of a public or signed ETag
+    value = value.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    return value.strip('"').split(".", 1)[0]
+
+
+def _file_clip_response(clip: Clip, etag=None):
+    full_file_path = os.path.abspath(clip.file_path)
+    mime_type = clip.mime_type or "application/octet-stream"
+    viewable_types = [
+        "text/",
+        "application/json",
+        "application/xml",
+        "application/javascript",
+    ]
+    is_viewable = any(mime_type.startswith(vtype) for vtype in viewable_types)
+
+    # private: a shared cache must not serve it around the access count
+    headers = {"Cache-Control": "private, no-cache"}
+    etag = etag or _resume_etag(clip)
+    if etag:
+        headers["ETag"] = etag
+    if not is_viewable:
+        filename = clip.filename or "file"
+        # Encode filename for Content-Disposition header to avoid latin-1 encoding errors
+        encoded_filename = quote(filename)
+        headers["Content-Disposition"] = (
+            f"attachment; filename*=utf-8''{encoded_filename}"
+        )
+
+    # FileResponse answers Range (single and multipart) and If-Range itself
+    return FileResponse(full_file_path, media_type=mime_type, headers=headers)
+
+
+def _free_file_response(request: Request, db: Session, code: str):
+    """
+    不消耗次数的文件请求：If-None-Match 命中时返回 304；
+    续传区间的 If-Range 是本剪贴板计费下载签发且未过宽限期的 ETag 时直接提供。
+    其他情况返回 None，走正常计数路径。
+    """
+    if_none_match = request.headers.get("if-none-match")
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    is_continuation = bool(if_range) and _is_continuation_range(range_header)
+    if not if_none_match and not is_continuation:
+        return None
+
+    clip = (
+        db.query(Clip)
+        .filter(
+            Clip.code == code,
+            Clip.content_type == "file",
+            Clip.expires_at > datetime.utcnow(),
+        )
+        .first()
+    )
+    if not clip or not clip.file_path or not os.path.exists(clip.file_path):
+        return None
+
+    if if_none_match and clip.file_hash:
+        # A 304 carries no content, so any ETag naming the same content
+        # matches, including signed ones past the resume grace period
+        for candidate in if_none_match.split(","):
+            etag = candidate.strip()
+            if etag == "*" or _etag_digest(etag) == clip.file_hash:
+                return Response(
+                    status_code=304,
+                    headers={
+                        "ETag": _file_etag(clip) if etag == "*" else etag,
+                        "Cache-Control": "private, no-cache",
+                    },
+                )
+
+    if is_continuation:
+        etag = _valid_resume_etag(clip, if_range)
+        if etag:
+            return _file_clip_response(clip, etag)
+    return None
+
+
+def _bundle_members(db: Session, clip: Clip):
+    members = (
+        db.query(ClipFile)
+        .filter(ClipFile.clip_id == clip.id)
+        .order_by(ClipFile.position)
+        .all()
+    )
+    if not all(os.path.exists(m.file_path) for m in members):
+        return None
+    return members
+
+
+def _bundle_response(request: Request, clip: Clip, members):
+    deflate = request.query_params.get("deflate", "").lower() in ("1", "yes", "true")
+    archive = stream_zip(
+        [(m.filename, m.file_path, m.file_size, clip.created_at) for m in members],
+        deflate=deflate,
+    )
+    encoded_filename = quote(clip.filename or "clipbox.zip")
+    return StreamingResponse(
+        archive,
+        media_type="application/zip",
+        headers={
+            "Cache-Control": "private, no-cache",
+            "Content-Disposition": f"attachment; filename*=utf-8''{encoded_filename}",
+        },
+    )
 
 
 @router.get("/{code}")
-def get_clip(code: str, db: Session = Depends(get_db)):
+def get_clip(request: Request, code: str, db: Session = Depends(get_db)):
+    cached = clip_cache.consume(code)
+    if cached:
+        return _text_clip_response(request, *cached)
+
+    free_response = _free_file_response(request, db, code)
+    if free_response is not None:
+        db.rollback()
+        return free_response
+
+    # The conditional decrement alone decides whether this read is served,
+    # so concurrent readers can never exceed the access limit
+    if not consume_access(db, code):
+        db.rollback()
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
     clip = db.query(Clip).filter_by(code=code).first()
     if not clip:
+        db.rollback()
         return JSONResponse({"error": "Not found"}, status_code=404)
 
-    if clip.is_expired():
-        if clip.content_type == "file" and clip.file_path:
-            try:
-                other_refs = 0
-                if clip.file_hash:
-                    other_refs = (
-                        db.query(Clip)
-                        .filter(Clip.file_hash == clip.file_hash, Clip.id != clip.id)
-                        .count()
-                    )
-                if other_refs == 0 and os.path.exists(clip.file_path):
-                    os.remove(clip.file_path)
-            except OSError:
-                pass
+    if clip.content_type == "file":
+        if not os.path.exists(clip.file_path):
+            delete_clip(db, clip)
+            db.commit()
+            return JSONResponse({"error": "Not found"}, status_code=404)
 
-        db.delete(clip)
+        # Keep a still-valid validator, so a charged range request that
+        # carries it in If-Range is answered with 206 rather than the file
+        etag = _valid_resume_etag(clip, request.headers.get("if-range"))
+        response = _file_clip_response(clip, etag)
         db.commit()
-        return JSONResponse({"error": "Not found"}, status_code=404)
+        return response
 
-    if clip.content_type == "link":
-        if clip.access_count <= 0:
-            db.delete(clip)
-            db.commit()
+    if clip.content_type == "bundle":
+        members = _bundle_members(db, clip)
+        if not members:
+            # A member file is missing: give the access back
+            db.rollback()
             return JSONResponse({"error": "Not found"}, status_code=404)
+        response = _bundle_response(request, clip, members)
+        db.commit()
+        return response
 
-        clip.access_count -= 1
-        if clip.access_count <= 0:
-            db.delete(clip)
+    if clip.file_path:
+        # Spilled text: stream it from disk. The row is left for expiry
+        # cleanup so the file outlives this response
+        if not os.path.exists(clip.file_path):
+            delete_clip(db, clip)
+            db.commit()
+            return JSONResponse({"error": "Not found"}, status_code=404)
+        response = FileResponse(
+            os.path.abspath(clip.file_path),
+            media_type="text/plain; charset=utf-8",
+            headers={"Cache-Control": "private, no-cache"},
+        )
         db.commit()
+        return response
 
-        return RedirectResponse(url=clip.content, status_code=302)
+    content_type = clip.content_type
+    content_encoding = clip.content_encoding
+    content = clip.content_blob if content_encoding else clip.content
+    remaining = clip.access_count
+    expires_at = clip.expires_at
+    # Text and links are small, drop them as soon as the last read is served
+    if remaining <= 0:
+        delete_clip(db, clip)
+    db.commit()
 
-    if clip.content_type == "file":
-        full_file_path = os.path.abspath(clip.file_path)
+    clip_cache.put(code, content, content_type, expires_at, remaining, content_encoding)
+    return _text_clip_response(request, content, content_type, content_encoding)
 
-        if not os.path.exists(full_file_path):
-            db.delete(clip)
-            db.commit()
-            return JSONResponse({"error": "Not found"}, status_code=404)
 
-        mime_type = clip.mime_type or "application/octet-stream"
-        viewable_types = [
-            "text/",
-            "application/json",
-            "application/xml",
-            "application/javascript",
-        ]
-        is_viewable = any(mime_type.startswith(vtype) for vtype in viewable_types)
-
-        headers = {}
-        if not is_viewable:
-            filename = clip.filename or "file"
-            # Encode filename for Content-Disposition header to avoid latin-1 encoding errors
-            encoded_filename = quote(filename)
-            headers["Content-Disposition"] = (
-                f"attachment; filename*=utf-8''{encoded_filename}"
-            )
+@router.get("/{code}/{index}")
+def get_bundle_member(code: str, index: int, db: Session = Depends(get_db)):
+    if not consume_access(db, code):
+        db.rollback()
+        return JSONResponse({"error": "Not found"}, status_code=404)
 
-        return FileResponse(full_file_path, media_type=mime_type, headers=headers)
+    clip = db.query(Clip).filter_by(code=code).first()
+    member = None
+    if clip and clip.content_type == "bundle":
+        member = (
+            db.query(ClipFile)
+            .filter(ClipFile.clip_id == clip.id, ClipFile.position == index)
+            .first()
+        )
+    if not member or not os.path.exists(member.file_path):
+        # Not a bundle member: give the access back
+        db.rollback()
+        return JSONResponse({"error": "Not found"}, status_code=404)
 
-    clip.access_count -= 1
-    if clip.access_count <= 0:
-        db.delete(clip)
+    mime_type = member.mime_type or "application/octet-stream"
+    encoded_filename = quote(os.path.basename(member.filename))
+    response = FileResponse(
+        os.path.abspath(member.file_path),
+        media_type=mime_type,
+        headers={
+            "Cache-Control": "private, no-cache",
+            "ETag": f'"{member.file_hash}"',
+            "Content-Disposition": f"attachment; filename*=utf-8''{encoded_filename}",
+        },
+    )
     db.commit()
+    return response
 
-    content_type = clip.content_type
-    media_type = (
-        f"{content_type}; charset=utf-8"
-        if content_type != "text/plain"
-        else "text/plain; charset=utf-8"
-    )
-    return Response(content=clip.content, media_type=media_type)
+
+@router.post("/upload/prepare")
+def prepare_upload(
+    request: Request,
+    sha256: str = Form(...),
+    size: int = Form(...),
+    filename: str = Form(...),
+    count: int = Form(1000),
+    expire: int = Form(604800),
+    db: Session = Depends(get_db),
+):
+    # Pre-flight for instant uploads: the client only sends the bytes to
+    # /upload when this reports a miss.
+    client_hash = sha256.strip().lower()
+    if not _is_valid_sha256(client_hash):
+        return JSONResponse({"error": "Invalid sha256"}, status_code=400)
+
+    if not filename.strip():
+        return JSONResponse({"error": "No file selected"}, status_code=400)
+
+    if size < 0:
+        return JSONResponse({"error": "Invalid size"}, status_code=400)
+
+    if size > settings.MAX_UPLOAD_FILE_SIZE:
+        return JSONResponse({"error": "File too large"}, status_code=413)
+
+    # Another client may be uploading the same content right now
+    blob = wait_for_blob(db, client_hash, size)
+    if blob:
+        code = allocate_code()
+        result = _create_instant_clip(
+            db,
+            blob,
+            code,
+            filename.strip(),
+            get_real_ip(request),
+            count,
+            expire,
+        )
+        if result is not None:
+            return result
+
+    instant_upload.inc("miss")
+    return {"instant_upload": False}
 
 
 @router.post("/upload")
 def upload_file(
     request: Request,
-    background_tasks: BackgroundTasks,
     count: int = Form(1000),
     expire: int = Form(604800),
     client_sha256: str = Form(""),
@@ -226,239 +813,625 @@ def upload_file(
     if not file or not file.filename:
         return JSONResponse({"error": "No file selected"}, status_code=400)
 
-    current_date = datetime.now().strftime("%Y-%m-%d")
-    upload_dir = os.path.join("data", current_date)
-    os.makedirs(upload_dir, exist_ok=True)
-
-    while True:
-        code = str(random.randint(10000, 99999))
-        if not db.query(Clip).filter_by(code=code).first():
-            break
+    code = allocate_code()
 
     original_filename = file.filename or f"file_{code}"
     client_hash = client_sha256.strip().lower()
-
-    def _is_valid_sha256(h: str) -> bool:
-        return len(h) == 64 and all(c in "0123456789abcdef" for c in h)
-
     client_hash_valid = _is_valid_sha256(client_hash)
+    client_ip = get_real_ip(request)
 
-    def sanitize_filename(name: str) -> str:
-        base = os.path.basename(name)
-        illegal = '<>:"/\\|?*'
-        cleaned = "".join("_" if (ch in illegal or ord(ch) < 32) else ch for ch in base)
-        return cleaned or f"file_{code}"
-
-    safe_name_for_path = sanitize_filename(original_filename)
-    file_path = os.path.join(upload_dir, f"{code}_{safe_name_for_path}")
+    # Content is already stored: skip writing another copy to disk.
+    claim_owner = None
+    if client_hash_valid:
+        owner = uuid.uuid4().hex
+        blob, claimed = _find_or_claim_blob(db, client_hash, owner)
+        if claimed:
+            claim_owner = owner
+        if blob:
+            result = _create_instant_clip(
+                db,
+                blob,
+                code,
+                original_filename,
+                client_ip,
+                count,
+                expire,
+            )
+            if result is not None:
+                return result
+        instant_upload.inc("miss")
 
-    file_size = 0
-    max_file_size = settings.MAX_UPLOAD_FILE_SIZE
+    try:
+        return _save_uploaded_file(
+            db,
+            file,
+            code,
+            original_filename,
+            client_hash if client_hash_valid else None,
+            client_ip,
+            count,
+            expire,
+        )
+    finally:
+        if claim_owner:
+            release_blob_claim(client_hash, claim_owner)
+
+
+def _save_uploaded_file(
+    db: Session,
+    file: UploadFile,
+    code: str,
+    original_filename: str,
+    client_hash,
+    client_ip,
+    count: int,
+    expire: int,
+):
+    reservation = reserve_space(file.size or 0)
+    if reservation is None:
+        return _insufficient_storage()
 
     try:
-        with open(file_path, "wb") as f:
-            while True:
-                chunk = file.file.read(8192)
-                if not chunk:
-                    break
-                f.write(chunk)
-                file_size += len(chunk)
-                if file_size > max_file_size:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                    return JSONResponse({"error": "File too large"}, status_code=413)
-    except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        return JSONResponse(
-            {"error": f"Failed to save file: {str(e)}"}, status_code=500
+        tmp_path = temp_upload_path()
+        try:
+            file_size, file_hash = save_chunks(
+                iter(lambda: file.file.read(COPY_CHUNK_SIZE), b""),
+                tmp_path,
+                settings.MAX_UPLOAD_FILE_SIZE,
+            )
+        except FileTooLarge:
+            return JSONResponse({"error": "File too large"}, status_code=413)
+        except Exception as e:
+            return JSONResponse(
+                {"error": f"Failed to save file: {str(e)}"}, status_code=500
+            )
+
+        return _register_uploaded_file(
+            db,
+            code,
+            original_filename,
+            tmp_path,
+            file_size,
+            file_hash,
+            client_hash,
+            client_ip,
+            count,
+            expire,
         )
+    finally:
+        reservation.release()
+
+
+# Storage reserved at a time for a body whose length is not known up front
+_RESERVE_STEP = 8 * 1024 * 1024
+
+
+async def _reserved_stream(stream, reservation, reserved):
+    # Grows the reservation ahead of the bytes written, so a chunked body
+    # is held to the storage budget while it streams in
+    received = 0
+    async for data in stream:
+        received += len(data)
+        if received > reserved:
+            needed = received - reserved
+            extra = max(_RESERVE_STEP, needed)
+            if not await run_in_threadpool(reservation.grow, extra):
+                # A whole step may not fit while the bytes so far still do
+                if extra == needed or not await run_in_threadpool(
+                    reservation.grow, needed
+                ):
+                    raise StorageFull()
+                extra = needed
+            reserved += extra
+        yield data
 
-    mime_type, _ = mimetypes.guess_type(original_filename)
-    if not mime_type:
-        mime_type = "application/octet-stream"
 
+@router.put("/upload/raw")
+async def upload_raw(
+    request: Request,
+    filename: str,
+    count: int = 1000,
+    expire: int = 604800,
+    client_sha256: str = "",
+    db: Session = Depends(get_db),
+):
+    """
+    以原始请求体上传单个文件，文件名等元数据放在查询参数中。
+    请求体边接收边写入数据目录并计算摘要，不经过 multipart 临时文件，
+    也不在等待网络数据时占用线程池。
+    """
+    original_filename = filename.strip()
+    if not original_filename:
+        return JSONResponse({"error": "No file selected"}, status_code=400)
+
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > settings.MAX_UPLOAD_FILE_SIZE:
+        return JSONResponse({"error": "File too large"}, status_code=413)
+
+    client_hash = client_sha256.strip().lower()
+    client_hash_valid = _is_valid_sha256(client_hash)
     client_ip = get_real_ip(request)
+    code = await run_in_threadpool(allocate_code)
 
+    # Decided before the body is read: with Expect: 100-continue a hit
+    # never makes the client send the bytes at all. Nothing is claimed yet,
+    # a slow body must not keep other uploads of the digest waiting
     if client_hash_valid:
-        existing_clip = db.query(Clip).filter_by(file_hash=client_hash).first()
-
-        if (
-            existing_clip
-            and existing_clip.file_path
-            and os.path.exists(existing_clip.file_path)
-        ):
-            if os.path.exists(file_path):
+        blob = await run_in_threadpool(find_blob, db, client_hash)
+        if blob:
+            result = await run_in_threadpool(
+                _create_instant_clip,
+                db,
+                blob,
+                code,
+                original_filename,
+                client_ip,
+                count,
+                expire,
+            )
+            if result is not None:
+                return result
+        instant_upload.inc("miss")
+
+    reservation = None
+    try:
+        expected_size = int(content_length) if content_length.isdigit() else 0
+        reservation = await run_in_threadpool(reserve_space, expected_size)
+        if reservation is None:
+            return _insufficient_storage()
+
+        tmp_path = temp_upload_path()
+        try:
+            file_size, file_hash = await save_stream(
+                _reserved_stream(request.stream(), reservation, expected_size),
+                tmp_path,
+                settings.MAX_UPLOAD_FILE_SIZE,
+            )
+        except FileTooLarge:
+            return JSONResponse({"error": "File too large"}, status_code=413)
+        except StorageFull:
+            return _insufficient_storage()
+        except ClientDisconnect:
+            return JSONResponse({"error": "Upload interrupted"}, status_code=400)
+        except Exception as e:
+            return JSONResponse(
+                {"error": f"Failed to save file: {str(e)}"}, status_code=500
+            )
+
+        # The bytes are on disk: claim the digest only while storing them,
+        # so concurrent instant uploads wait moments for the commit
+        owner = uuid.uuid4().hex
+        claimed = await run_in_threadpool(claim_blob, file_hash, owner)
+        try:
+            return await run_in_threadpool(
+                _register_uploaded_file,
+                db,
+                code,
+                original_filename,
+                tmp_path,
+                file_size,
+                file_hash,
+                client_hash if client_hash_valid else None,
+                client_ip,
+                count,
+                expire,
+            )
+        finally:
+            if claimed:
+                await run_in_threadpool(release_blob_claim, file_hash, owner)
+    finally:
+        if reservation is not None:
+            await run_in_threadpool(reservation.release)
+
+
+def _bundle_member_name(filename: str, taken: set):
+    # Keep folder structure from relative paths, never escape the archive root
+    parts = [
+        p for p in filename.replace("\\", "/").split("/") if p not in ("", ".", "..")
+    ]
+    name = "/".join(parts) or "file"
+    if name in taken:
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while f"{stem} ({n}){ext}" in taken:
+            n += 1
+        name = f"{stem} ({n}){ext}"
+    taken.add(name)
+    return name
+
+
+@router.post("/upload/bundle")
+def upload_bundle(
+    request: Request,
+    count: int = Form(1000),
+    expire: int = Form(604800),
+    name: str = Form(""),
+    files: List[UploadFile] = File(...),
+    db: Session = Depends(get_db),
+):
+    files = [f for f in files if f and f.filename]
+    if not files:
+        return JSONResponse({"error": "No file selected"}, status_code=400)
+    if len(files) > settings.MAX_BUNDLE_FILES:
+        return JSONResponse({"error": "Too many files"}, status_code=400)
+    reservation = reserve_space(sum(f.size or 0 for f in files))
+    if reservation is None:
+        return _insufficient_storage()
+    try:
+        return _save_bundle(request, db, files, count, expire, name)
+    finally:
+        reservation.release()
+
+
+def _save_bundle(
+    request: Request,
+    db: Session,
+    files: List[UploadFile],
+    count: int,
+    expire: int,
+    name: str,
+):
+
+    def _discard_all(paths):
+        for path in paths:
+            if path and os.path.exists(path):
                 try:
-                    os.remove(file_path)
+                    os.remove(path)
                 except OSError:
                     pass
-            new_clip = Clip(
-                code=code,
-                content_type="file",
-                filename=original_filename,
-                file_path=existing_clip.file_path,
-                file_hash=client_hash,
-                file_size=existing_clip.file_size,
-                mime_type=existing_clip.mime_type or mime_type,
-                client_ip=client_ip,
-                access_count=count,
-                max_count=count,
-                expire_seconds=expire,
-            )
-            try:
-                db.add(new_clip)
-                db.commit()
-            except Exception:
-                db.rollback()
-                return JSONResponse({"error": "Database error"}, status_code=500)
-
-            def _verify_client_hash(clip_id, trusted_hash, path_for_verify):
-                from app.database import SessionLocal
-
-                with SessionLocal() as db_session:
-                    if not path_for_verify or not os.path.exists(path_for_verify):
-                        return
-                    h = hashlib.sha256()
-                    with open(path_for_verify, "rb") as rf:
-                        for chunk in iter(lambda: rf.read(1024 * 1024), b""):
-                            h.update(chunk)
-                    server_hash = h.hexdigest()
-                    if server_hash != trusted_hash:
-                        bad = db_session.query(Clip).get(clip_id)
-                        if bad:
-                            db_session.delete(bad)
-                            db_session.commit()
-
-            background_tasks.add_task(
-                _verify_client_hash, new_clip.id, client_hash, existing_clip.file_path
+
+    saved = []
+    total_size = 0
+    try:
+        for upload in files:
+            tmp_path = temp_upload_path()
+            file_size, file_hash = save_chunks(
+                iter(lambda: upload.file.read(COPY_CHUNK_SIZE), b""),
+                tmp_path,
+                settings.MAX_UPLOAD_FILE_SIZE,
             )
-            return {"code": code, "instant_upload": True}
+            saved.append((tmp_path, file_size, file_hash, upload.filename))
+            total_size += file_size
+            if total_size > settings.MAX_BUNDLE_SIZE:
+                raise FileTooLarge()
+    except FileTooLarge:
+        _discard_all(p for p, _, _, _ in saved)
+        return JSONResponse({"error": "File too large"}, status_code=413)
+    except Exception as e:
+        _discard_all(p for p, _, _, _ in saved)
+        return JSONResponse(
+            {"error": f"Failed to save file: {str(e)}"}, status_code=500
+        )
 
+    code = allocate_code()
+    created_paths = []
+    try:
         clip = Clip(
             code=code,
-            content_type="file",
-            filename=original_filename,
-            file_path=file_path,
-            file_hash=client_hash,
-            file_size=file_size,
-            mime_type=mime_type,
-            client_ip=client_ip,
+            content_type="bundle",
+            filename=name.strip() or f"clipbox-{code}.zip",
+            file_size=total_size,
+            mime_type="application/zip",
+            client_ip=get_real_ip(request),
             access_count=count,
             max_count=count,
             expire_seconds=expire,
         )
+        db.add(clip)
+        db.flush()
+
+        taken = set()
+        for position, (tmp_path, file_size, file_hash, filename) in enumerate(saved):
+            mime_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            # Members share the blob store and its dedup with single files
+            file_path, created = store_blob(
+                db, tmp_path, file_hash, file_size, mime_type
+            )
+            if created:
+                created_paths.append(file_path)
+            db.add(
+                ClipFile(
+                    clip_id=clip.id,
+                    position=position,
+                    filename=_bundle_member_name(filename, taken),
+                    file_hash=file_hash,
+                    file_path=file_path,
+                    file_size=file_size,
+                    mime_type=mime_type,
+                )
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        _discard_all(p for p, _, _, _ in saved)
+        _discard_all(created_paths)
+        return JSONResponse({"error": "Database error"}, status_code=500)
 
-        try:
-            db.add(clip)
-            db.commit()
-        except Exception:
-            db.rollback()
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            return JSONResponse({"error": "Database error"}, status_code=500)
-
-        def _verify_and_cleanup(clip_id, trusted_hash, path_current):
-            from app.database import SessionLocal
-
-            with SessionLocal() as db_session:
-                h = hashlib.sha256()
-                with open(path_current, "rb") as rf:
-                    for chunk in iter(lambda: rf.read(1024 * 1024), b""):
-                        h.update(chunk)
-                server_hash = h.hexdigest()
-                if server_hash != trusted_hash:
-                    if os.path.exists(path_current):
-                        try:
-                            os.remove(path_current)
-                        except OSError:
-                            pass
-                    bad = db_session.query(Clip).get(clip_id)
-                    if bad:
-                        db_session.delete(bad)
-                        db_session.commit()
-
-        background_tasks.add_task(_verify_and_cleanup, clip.id, client_hash, file_path)
-        return {"code": code, "instant_upload": False}
+    _schedule_expiry(expire)
+    upload_bytes.inc("bundle", amount=total_size)
+    return {"code": code, "files": len(saved)}
 
-    clip = Clip(
-        code=code,
-        content_type="file",
-        filename=original_filename,
-        file_path=file_path,
-        file_hash=None,
-        file_size=file_size,
-        mime_type=mime_type,
+
+def _get_upload_session(db: Session, session_id: str):
+    # Session ids are used as directory names, so only accept our own format
+    if len(session_id) != 32 or any(c not in "0123456789abcdef" for c in session_id):
+        return None
+    session = db.query(UploadSession).filter_by(id=session_id).first()
+    if not session or session.expires_at < datetime.utcnow():
+        return None
+    return session
+
+
+def _received_chunks(session: UploadSession):
+    chunk_dir = upload_session_dir(session.id)
+    if not os.path.isdir(chunk_dir):
+        return []
+    received = []
+    for name in os.listdir(chunk_dir):
+        index, ext = os.path.splitext(name)
+        if ext == ".part" and index.isdigit() and int(index) < session.total_chunks:
+            received.append(int(index))
+    return sorted(received)
+
+
+@router.post("/upload/session")
+def create_upload_session(
+    request: Request,
+    filename: str = Form(...),
+    size: int = Form(...),
+    chunk_size: int = Form(0),
+    client_sha256: str = Form(""),
+    count: int = Form(1000),
+    expire: int = Form(604800),
+    db: Session = Depends(get_db),
+):
+    filename = filename.strip()
+    if not filename:
+        return JSONResponse({"error": "No file selected"}, status_code=400)
+
+    if size < 0:
+        return JSONResponse({"error": "Invalid size"}, status_code=400)
+
+    if size > settings.MAX_UPLOAD_FILE_SIZE:
+        return JSONResponse({"error": "File too large"}, status_code=413)
+
+    chunk_size = chunk_size or settings.UPLOAD_CHUNK_SIZE
+    if chunk_size <= 0 or chunk_size > settings.MAX_UPLOAD_CHUNK_SIZE:
+        return JSONResponse({"error": "Invalid chunk size"}, status_code=400)
+    # Only a file that fits into a single chunk may use a smaller one; the
+    # chunk count bounds the status listing and the finalize loop
+    if chunk_size < settings.MIN_UPLOAD_CHUNK_SIZE and size > chunk_size:
+        return JSONResponse({"error": "Invalid chunk size"}, status_code=400)
+    total_chunks = max(1, -(-size // chunk_size))
+    if total_chunks > settings.MAX_UPLOAD_CHUNKS:
+        return JSONResponse({"error": "Too many chunks"}, status_code=400)
+
+    client_hash = client_sha256.strip().lower()
+    client_hash_valid = _is_valid_sha256(client_hash)
+    client_ip = get_real_ip(request)
+
+    session_id = uuid.uuid4().hex
+    if client_hash_valid:
+        # No claim here: a session may take hours to upload its chunks and
+        # must not keep other uploads of the digest waiting. It claims the
+        # digest only while finalize assembles and stores the file
+        blob = wait_for_blob(db, client_hash, size)
+        if blob:
+            code = allocate_code()
+            result = _create_instant_clip(
+                db,
+                blob,
+                code,
+                filename,
+                client_ip,
+                count,
+                expire,
+            )
+            if result is not None:
+                return result
+        instant_upload.inc("miss")
+
+    # Held for the session's lifetime and renewed with it as chunks arrive
+    reservation = reserve_space(size, session_id, settings.UPLOAD_SESSION_TTL)
+    if reservation is None:
+        return _insufficient_storage()
+
+    session = UploadSession(
+        id=session_id,
+        filename=filename,
+        file_size=size,
+        chunk_size=chunk_size,
+        total_chunks=total_chunks,
+        client_hash=client_hash if client_hash_valid else None,
         client_ip=client_ip,
         access_count=count,
-        max_count=count,
         expire_seconds=expire,
+        expires_at=datetime.utcnow() + timedelta(seconds=settings.UPLOAD_SESSION_TTL),
     )
 
     try:
-        db.add(clip)
+        db.add(session)
         db.commit()
     except Exception:
         db.rollback()
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        reservation.release()
         return JSONResponse({"error": "Database error"}, status_code=500)
 
-    def _compute_and_finalize(clip_id, path):
-        from app.database import SessionLocal
+    return {
+        "session_id": session.id,
+        "chunk_size": session.chunk_size,
+        "total_chunks": session.total_chunks,
+        "expires_at": session.expires_at.isoformat(),
+    }
 
-        with SessionLocal() as db_session:
-            try:
-                h = hashlib.sha256()
-                size = 0
-                with open(path, "rb") as rf:
-                    for data in iter(lambda: rf.read(1024 * 1024), b""):
-                        h.update(data)
-                        size += len(data)
-                file_hash_local = h.hexdigest()
-                existing = (
-                    db_session.query(Clip)
-                    .filter(Clip.file_hash == file_hash_local, Clip.id != clip_id)
-                    .first()
-                )
-                clip_row = db_session.query(Clip).get(clip_id)
-                if not clip_row:
-                    return
-                clip_row.file_hash = file_hash_local
-                if (
-                    existing
-                    and existing.file_path
-                    and os.path.exists(existing.file_path)
-                ):
-                    if os.path.exists(path):
-                        try:
-                            os.remove(path)
-                        except OSError:
-                            pass
-                    clip_row.file_path = existing.file_path
-                    clip_row.file_size = existing.file_size or size
-                    clip_row.mime_type = existing.mime_type or clip_row.mime_type
-                else:
-                    clip_row.file_size = size
-                db_session.commit()
-            except Exception:
-                db_session.rollback()
-
-    background_tasks.add_task(_compute_and_finalize, clip.id, file_path)
-    return {"code": code}
 
+@router.get("/upload/session/{session_id}")
+def get_upload_session(session_id: str, db: Session = Depends(get_db)):
+    session = _get_upload_session(db, session_id)
+    if not session:
+        return JSONResponse({"error": "Not found"}, status_code=404)
 
-@router.get("/timetask_cleanup_files")
-def timetask_cleanup_files(db: Session = Depends(get_db)):
+    received = _received_chunks(session)
+    received_set = set(received)
+    return {
+        "session_id": session.id,
+        "chunk_size": session.chunk_size,
+        "total_chunks": session.total_chunks,
+        "received": received,
+        "missing": [i for i in range(session.total_chunks) if i not in received_set],
+        "expires_at": session.expires_at.isoformat(),
+    }
+
+
+@router.put("/upload/session/{session_id}/{index}")
+def upload_chunk(
+    session_id: str,
+    index: int,
+    chunk: UploadFile = File(...),
+    db: Session = Depends(get_db),
+):
+    session = _get_upload_session(db, session_id)
+    if not session:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
+    if index < 0 or index >= session.total_chunks:
+        return JSONResponse({"error": "Invalid chunk index"}, status_code=400)
+
+    expected_size = session.chunk_length(index)
+    chunk_dir = upload_session_dir(session.id)
+    os.makedirs(chunk_dir, exist_ok=True)
+    chunk_path = os.path.join(chunk_dir, f"{index}.part")
+    # Chunks may be retried in parallel, so write aside and rename into place
+    tmp_path = f"{chunk_path}.{uuid.uuid4().hex}.tmp"
+
+    chunk_size = 0
     try:
-        expired_count = cleanup_expired_clips(db)
-        orphaned_count = cleanup_orphaned_files(db)
-        empty_dir_count = cleanup_empty_directories()
-        return {
-            "expired": expired_count,
-            "orphaned_files": orphaned_count,
-            "empty_dirs": empty_dir_count,
-            "message": f"Cleaned {expired_count} expired, {orphaned_count} orphaned files, {empty_dir_count} empty dirs",
-        }
+        with open(tmp_path, "wb") as f:
+            for data in iter(lambda: chunk.file.read(COPY_CHUNK_SIZE), b""):
+                f.write(data)
+                chunk_size += len(data)
+                if chunk_size > expected_size:
+                    break
+        if chunk_size != expected_size:
+            os.remove(tmp_path)
+            return JSONResponse({"error": "Chunk size mismatch"}, status_code=400)
+        os.replace(tmp_path, chunk_path)
     except Exception as e:
-        return JSONResponse({"error": f"Cleanup failed: {str(e)}"}, status_code=500)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return JSONResponse(
+            {"error": f"Failed to save chunk: {str(e)}"}, status_code=500
+        )
+
+    # Keep the session alive while chunks keep arriving
+    session.expires_at = datetime.utcnow() + timedelta(
+        seconds=settings.UPLOAD_SESSION_TTL
+    )
+    Reservation(session.id, settings.UPLOAD_SESSION_TTL).renew()
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+
+    return {"index": index, "size": chunk_size}
+
+
+@router.post("/upload/session/{session_id}/finalize")
+def finalize_upload_session(
+    session_id: str,
+    db: Session = Depends(get_db),
+):
+    session = _get_upload_session(db, session_id)
+    if not session:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
+    received = set(_received_chunks(session))
+    missing = [i for i in range(session.total_chunks) if i not in received]
+    if missing:
+        return JSONResponse(
+            {"error": "Missing chunks", "missing": missing}, status_code=409
+        )
+
+    # Lets concurrent instant uploads of the digest wait for this file
+    # instead of missing; held only while it is assembled and stored
+    client_hash = session.client_hash
+    holds_claim = client_hash is not None and claim_blob(client_hash, session_id)
+    try:
+        return _finalize_session(db, session)
+    finally:
+        if holds_claim:
+            release_blob_claim(client_hash, session_id)
+
+
+def _finalize_session(db: Session, session: UploadSession):
+    code = allocate_code()
+    tmp_path = temp_upload_path()
+    chunk_dir = upload_session_dir(session.id)
+
+    def _read_chunks():
+        for index in range(session.total_chunks):
+            with open(os.path.join(chunk_dir, f"{index}.part"), "rb") as rf:
+                yield from iter(lambda: rf.read(COPY_CHUNK_SIZE), b"")
+
+    try:
+        file_size, file_hash = save_chunks(_read_chunks(), tmp_path)
+    except Exception as e:
+        return JSONResponse(
+            {"error": f"Failed to save file: {str(e)}"}, status_code=500
+        )
+
+    # Only one concurrent finalize may turn the session into a clip
+    session_fields = (
+        session.filename,
+        session.client_hash,
+        session.client_ip,
+        session.access_count,
+        session.expire_seconds,
+    )
+    try:
+        claimed = db.query(UploadSession).filter_by(id=session.id).delete()
+        db.commit()
+    except Exception:
+        db.rollback()
+        claimed = 0
+    if not claimed:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    filename, client_hash, client_ip, count, expire = session_fields
+    try:
+        return _register_uploaded_file(
+            db,
+            code,
+            filename,
+            tmp_path,
+            file_size,
+            file_hash,
+            client_hash,
+            client_ip,
+            count,
+            expire,
+        )
+    finally:
+        Reservation(session.id).release()
+
+
+@router.delete("/upload/session/{session_id}")
+def abort_upload_session(session_id: str, db: Session = Depends(get_db)):
+    session = _get_upload_session(db, session_id)
+    if not session:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
+    try:
+        db.delete(session)
+        db.commit()
+    except Exception:
+        db.rollback()
+        return JSONResponse({"error": "Database error"}, status_code=500)
+
+    shutil.rmtree(upload_session_dir(session_id), ignore_errors=True)
+    Reservation(session_id).release()
+    return {"session_id": session_id}
@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse, Response
+from app.config import settings
+from app.metrics import CONTENT_TYPE, registry
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+def metrics():
+    if not settings.METRICS_ENABLED:
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return Response(registry.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,260 @@
+import heapq
+import threading
+import time
+import uuid
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from app.config import settings
+from app.database import (
+    Clip,
+    SessionLocal,
+    acquire_lease,
+    cleanup_expired_clips,
+    cleanup_expired_upload_sessions,
+    engine,
+    prune_leases,
+    release_lease,
+)
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = "expiry_scheduler"
+
+# Never sleep longer than this, so a stop request or lost lease is noticed
+_MAX_SLEEP = 60.0
+
+
+class ExpiryScheduler:
+    """
+    进程内过期调度器。
+    按时间窗口从数据库预加载即将到期的 expires_at 放入最小堆，
+    在到期时刻附近删除剪贴板及其文件，并定期清理上传会话和孤儿文件。
+    多个 worker 通过 cb_leases 租约选主，同一时间只有一个实例执行清理；
+    主实例每隔 EXPIRY_POLL_INTERVAL 秒读入其他 worker 新建、落在窗口内的剪贴板。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._window_end = None
+        # Highest clip id already considered for the loaded window
+        self._last_seen_id = 0
+        self._poll_due = 0.0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._owner = uuid.uuid4().hex
+        self._leader = False
+        self._lease_due = 0.0
+        self._maintenance_due = 0.0
+
+    @property
+    def is_leader(self):
+        return self._leader
+
+    def start(self):
+        if not settings.EXPIRY_SCHEDULER_ENABLED or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="expiry-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=30)
+        self._thread = None
+        if self._leader:
+            self._set_leader(False)
+            try:
+                release_lease(LEASE_NAME, self._owner)
+            except Exception as e:
+                logger.warning(f"Release scheduler lease failed: {e}")
+
+    def schedule(self, expires_at):
+        """
+        新建剪贴板时调用，到期时间落在已加载窗口内则加入堆。
+        窗口之外的由下次加载窗口时读入；非主实例直接忽略，由主实例轮询读入。
+        """
+        if expires_at is None or not self._leader:
+            return
+        with self._lock:
+            if self._window_end is None or expires_at > self._window_end:
+                return
+            heapq.heappush(self._heap, expires_at)
+            is_next = self._heap[0] == expires_at
+        if is_next:
+            self._wake.set()
+
+    def _set_leader(self, leader):
+        if leader != self._leader:
+            logger.info(
+                "Expiry scheduler became leader"
+                if leader
+                else "Expiry scheduler lost leadership"
+            )
+        self._leader = leader
+        if not leader:
+            with self._lock:
+                self._heap = []
+                self._window_end = None
+
+    def _renew_lease(self):
+        try:
+            leader = acquire_lease(
+                LEASE_NAME, self._owner, settings.EXPIRY_LEASE_SECONDS
+            )
+        except Exception as e:
+            logger.warning(f"Renew scheduler lease failed: {e}")
+            leader = False
+        self._set_leader(leader)
+        self._lease_due = time.monotonic() + settings.EXPIRY_LEASE_SECONDS / 3
+
+    def _load_window(self, now):
+        window_end = now + timedelta(seconds=settings.EXPIRY_WINDOW_SECONDS)
+        with engine.begin() as conn:
+            # Read first, so rows inserted while loading are left to the poll
+            last_seen_id = conn.execute(select(func.max(Clip.id))).scalar() or 0
+            upcoming = (
+                conn.execute(
+                    select(Clip.expires_at)
+                    .where(Clip.id <= last_seen_id, Clip.expires_at <= window_end)
+                    .order_by(Clip.expires_at)
+                    .limit(settings.EXPIRY_WINDOW_MAX_ITEMS)
+                )
+                .scalars()
+                .all()
+            )
+        if len(upcoming) >= settings.EXPIRY_WINDOW_MAX_ITEMS:
+            # The window is full; load the rest once these are done
+            window_end = upcoming[-1]
+        with self._lock:
+            # Already sorted, which satisfies the heap invariant
+            self._heap = list(upcoming)
+            self._window_end = window_end
+            self._last_seen_id = last_seen_id
+        self._poll_due = time.monotonic() + settings.EXPIRY_POLL_INTERVAL
+
+    def _poll_new(self):
+        """
+        读入上次加载或轮询之后新建、到期时间落在已加载窗口内的剪贴板。
+        其他 worker 新建的剪贴板不会调用本实例的 schedule，靠这里及时加入堆。
+        """
+        with self._lock:
+            window_end = self._window_end
+            last_seen_id = self._last_seen_id
+        if window_end is None:
+            return
+        with engine.begin() as conn:
+            newest_id = conn.execute(select(func.max(Clip.id))).scalar() or 0
+            if newest_id <= last_seen_id:
+                return
+            arrived = (
+                conn.execute(
+                    select(Clip.expires_at).where(
+                        Clip.id > last_seen_id,
+                        Clip.id <= newest_id,
+                        Clip.expires_at <= window_end,
+                    )
+                )
+                .scalars()
+                .all()
+            )
+        with self._lock:
+            if self._window_end != window_end:
+                # Reloaded meanwhile, which already read these rows
+                return
+            for expires_at in arrived:
+                heapq.heappush(self._heap, expires_at)
+            self._last_seen_id = newest_id
+
+    def _pop_due(self, now):
+        due = 0
+        with self._lock:
+            while self._heap and self._heap[0] <= now:
+                heapq.heappop(self._heap)
+                due += 1
+        return due
+
+    def _tick(self):
+        now = datetime.utcnow()
+        if self._window_end is None or now >= self._window_end:
+            self._load_window(now)
+        elif time.monotonic() >= self._poll_due:
+            self._poll_due = time.monotonic() + settings.EXPIRY_POLL_INTERVAL
+            self._poll_new()
+
+        if self._pop_due(now):
+            db = SessionLocal()
+            try:
+                cleaned = cleanup_expired_clips(db)
+            finally:
+                db.close()
+            if cleaned:
+                logger.info(f"Expiry scheduler cleaned {cleaned} clips")
+
+        if time.monotonic() >= self._maintenance_due:
+            self._maintenance_due = time.monotonic() + settings.MAINTENANCE_INTERVAL
+            self._run_maintenance()
+
+    def _run_maintenance(self):
+        from app.budget import prune_reservations
+        from app.hashing import queue_unverified_blobs
+        from app.ratelimit import backend as rate_limit_backend
+        from app.reconcile import reconcile_storage
+
+        db = SessionLocal()
+        try:
+            sessions = cleanup_expired_upload_sessions(db)
+            progress = reconcile_storage(db)
+        finally:
+            db.close()
+        rate_limit_backend.prune()
+        # Blob claims and storage reservations left behind by crashed uploads
+        prune_leases()
+        prune_reservations()
+        queue_unverified_blobs()
+        logger.info(
+            f"Maintenance removed {sessions} upload sessions, "
+            f"{progress['removed_files']} orphaned files"
+        )
+        if not progress["complete"]:
+            # Continue the scan from its cursor soon instead of next interval
+            self._maintenance_due = time.monotonic() + _MAX_SLEEP
+
+    def _sleep_seconds(self):
+        deadlines = [self._lease_due - time.monotonic()]
+        if self._leader:
+            deadlines.append(self._maintenance_due - time.monotonic())
+            deadlines.append(self._poll_due - time.monotonic())
+            now = datetime.utcnow()
+            with self._lock:
+                if self._heap:
+                    deadlines.append((self._heap[0] - now).total_seconds())
+                if self._window_end is not None:
+                    deadlines.append((self._window_end - now).total_seconds())
+        return min(max(min(deadlines), 0.0), _MAX_SLEEP)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if time.monotonic() >= self._lease_due:
+                self._renew_lease()
+            if self._leader:
+                try:
+                    self._tick()
+                except Exception as e:
+                    logger.error(f"Expiry scheduler failed: {e}")
+                    # Reload the window next time in case it is inconsistent
+                    with self._lock:
+                        self._window_end = None
+                    self._stop.wait(1.0)
+            self._wake.wait(self._sleep_seconds())
+            self._wake.clear()
+
+
+expiry_scheduler = ExpiryScheduler()
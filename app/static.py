@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import logging
+from fastapi import Request
+from fastapi.responses import FileResponse, JSONResponse, Response
+from app.utils import accepts_encoding
+
+try:
+    import brotli
+except ImportError:  # optional: gzip variants are still served without it
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Larger files are streamed from disk instead of being held in memory
+MAX_CACHED_FILE_SIZE = 4 * 1024 * 1024
+# Compressing tiny files costs more in headers than it saves
+MIN_COMPRESS_SIZE = 1024
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+_COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "application/manifest+json",
+    "image/svg+xml",
+)
+
+# Preferred first
+_ENCODINGS = ("br", "gzip")
+_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+class _Asset:
+    __slots__ = ("path", "body", "media_type", "etag", "cache_control", "variants")
+
+    def __init__(self, path, body, media_type, etag, cache_control):
+        self.path = path
+        self.body = body
+        self.media_type = media_type
+        self.etag = etag
+        self.cache_control = cache_control
+        self.variants = {}
+
+
+def _is_compressible(media_type):
+    return any(media_type.startswith(t) for t in _COMPRESSIBLE_TYPES)
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class StaticSite:
+    """
+    启动时把 www/ 建成内存清单：文件内容、ETag、预压缩的 br/gzip 变体。
+    请求时只做一次字典查找，按 Accept-Encoding 协商编码，/assets 下带哈希的
+    文件使用 immutable 缓存，其他文件通过 ETag 重新验证。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._assets = {}
+        self._build()
+
+    def _build(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                # Build-time precompressed files are attached to their source
+                if key.endswith((".br", ".gz")) and os.path.isfile(path[:-3]):
+                    continue
+                asset = self._load(key, path)
+                if asset is not None:
+                    self._assets[key] = asset
+                    total += 1
+        logger.info(f"Indexed {total} static files from {self.root}")
+
+    def _load(self, key, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or media_type == "application/javascript":
+            media_type = f"{media_type}; charset=utf-8"
+        cache_control = (
+            IMMUTABLE_CACHE if key.startswith("assets/") else REVALIDATE_CACHE
+        )
+
+        if size > MAX_CACHED_FILE_SIZE:
+            st = os.stat(path)
+            etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+            return _Asset(path, None, media_type, etag, cache_control)
+
+        body = _read(path)
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        asset = _Asset(path, body, media_type, etag, cache_control)
+        if size >= MIN_COMPRESS_SIZE and _is_compressible(media_type):
+            for encoding in _ENCODINGS:
+                variant = self._compress(path, body, encoding)
+                if variant is not None and len(variant) < len(body):
+                    asset.variants[encoding] = variant
+        return asset
+
+    def _compress(self, path, body, encoding):
+        precompressed = path + _SUFFIXES[encoding]
+        if os.path.isfile(precompressed):
+            return _read(precompressed)
+        if encoding == "gzip":
+            return gzip.compress(body, compresslevel=9, mtime=0)
+        if encoding == "br" and brotli is not None:
+            return brotli.compress(body, quality=11)
+        return None
+
+    def _resolve(self, full_path):
+        key = full_path.strip("/")
+        asset = self._assets.get(key)
+        if asset is not None:
+            return asset
+        asset = self._assets.get(f"{key}/index.html" if key else "index.html")
+        if asset is not None:
+            return asset
+        # A missing hashed asset must not be answered with the SPA shell
+        if key.startswith("assets/"):
+            return None
+        return self._assets.get("index.html")
+
+    def response(self, request: Request, full_path: str):
+        # Allow requests to /api to pass through to the 404 handler if they don't match
+        if full_path.startswith("api/"):
+            return JSONResponse({"detail": "Not Found"}, status_code=404)
+
+        asset = self._resolve(full_path)
+        if asset is None:
+            return JSONResponse({"detail": "Not Found"}, status_code=404)
+
+        headers = {"ETag": asset.etag, "Cache-Control": asset.cache_control}
+        if asset.variants:
+            headers["Vary"] = "Accept-Encoding"
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and (
+            if_none_match.strip() == "*"
+            or asset.etag
+            in [v.strip().removeprefix("W/") for v in if_none_match.split(",")]
+        ):
+            return Response(status_code=304, headers=headers)
+
+        if asset.body is None:
+            return FileResponse(
+                asset.path, media_type=asset.media_type, headers=headers
+            )
+
+        for encoding in _ENCODINGS:
+            variant = asset.variants.get(encoding)
+            if variant is not None and accepts_encoding(request, encoding):
+                headers["Content-Encoding"] = encoding
+                return Response(variant, media_type=asset.media_type, headers=headers)
+        return Response(asset.body, media_type=asset.media_type, headers=headers)
@@ -0,0 +1,367 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from starlette.concurrency import run_in_threadpool
+from app.config import settings
+from app.database import (
+    STORAGE_BYTES_COUNTER,
+    Blob,
+    Clip,
+    ClipFile,
+    acquire_lease,
+    adjust_counter,
+    insert_ignore,
+    lease_active,
+    recycle_codes,
+    release_lease,
+)
+from app.cache import clip_cache
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+BLOB_DIR = os.path.join(settings.DATA_DIR, "blobs")
+TMP_DIR = os.path.join(settings.DATA_DIR, ".tmp")
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+def save_chunks(chunks, path, max_size=None):
+    """
+    将数据块写入 path，并在同一循环中计算 SHA-256。
+    返回 (size, sha256)；超过 max_size 时删除文件并抛出 FileTooLarge。
+    """
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise FileTooLarge()
+                h.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    digest = h.hexdigest()
+    remember_verified_digest(path, digest)
+    return size, digest
+
+
+async def save_stream(stream, path, max_size=None):
+    """
+    save_chunks 的异步版本：从异步迭代器（如 request.stream()）接收数据，
+    攒满 COPY_CHUNK_SIZE 后在线程池中一次写入并更新摘要，事件循环不被磁盘 I/O 阻塞。
+    返回 (size, sha256)；超过 max_size 时立即停止读取并抛出 FileTooLarge。
+    """
+    h = hashlib.sha256()
+    size = 0
+    buffer = bytearray()
+
+    def _flush(f, data):
+        h.update(data)
+        f.write(data)
+
+    try:
+        f = await run_in_threadpool(open, path, "wb")
+        try:
+            async for chunk in stream:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise FileTooLarge()
+                buffer += chunk
+                if len(buffer) >= COPY_CHUNK_SIZE:
+                    data, buffer = bytes(buffer), bytearray()
+                    await run_in_threadpool(_flush, f, data)
+            if buffer:
+                await run_in_threadpool(_flush, f, bytes(buffer))
+        finally:
+            await run_in_threadpool(f.close)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    digest = h.hexdigest()
+    remember_verified_digest(path, digest)
+    return size, digest
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as rf:
+        for chunk in iter(lambda: rf.read(COPY_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Digests computed by the server itself, keyed by (device, inode, size,
+# mtime) so moving a file into the blob store keeps its entry while a
+# replaced or modified file is never trusted.
+_verified_digests = OrderedDict()
+_verified_lock = threading.Lock()
+_VERIFIED_MAX_ENTRIES = 4096
+
+
+def _digest_key(path):
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def remember_verified_digest(path, digest):
+    try:
+        key = _digest_key(path)
+    except OSError:
+        return
+    with _verified_lock:
+        _verified_digests[key] = digest
+        _verified_digests.move_to_end(key)
+        while len(_verified_digests) > _VERIFIED_MAX_ENTRIES:
+            _verified_digests.popitem(last=False)
+
+
+def verified_digest(path):
+    try:
+        key = _digest_key(path)
+    except OSError:
+        return None
+    with _verified_lock:
+        digest = _verified_digests.get(key)
+        if digest is not None:
+            _verified_digests.move_to_end(key)
+        return digest
+
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest)
+
+
+def temp_upload_path():
+    os.makedirs(TMP_DIR, exist_ok=True)
+    return os.path.join(TMP_DIR, f"{uuid.uuid4().hex}.tmp")
+
+
+def _discard(path):
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"Delete file failed {path}: {e}")
+
+
+def _move_into_place(tmp_path, path):
+    # cleanup may remove an empty shard directory between makedirs and rename
+    for attempt in range(3):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(tmp_path, path)
+            return
+        except FileNotFoundError:
+            if attempt == 2 or not os.path.exists(tmp_path):
+                raise
+
+
+def find_blob(db, digest, size=None):
+    blob = db.query(Blob).filter_by(sha256=digest).first()
+    if not blob or (size is not None and blob.size != size):
+        return None
+    if not os.path.exists(blob.path):
+        return None
+    # Imported from a client-supplied hash: a miss until it has been checked
+    if not blob.verified and verified_digest(blob.path) != blob.sha256:
+        return None
+    return blob
+
+
+# How often a waiting upload checks whether the claimed blob has landed
+_CLAIM_POLL_INTERVAL = 0.2
+
+
+def claim_blob(digest, owner):
+    """
+    声明由 owner 写入 digest 对应的 blob，所有进程和节点之间互斥。
+    声明保存在 cb_leases 中，以摘要为名；持有者崩溃时在 BLOB_CLAIM_TTL 后失效。
+    """
+    return acquire_lease(digest, owner, settings.BLOB_CLAIM_TTL)
+
+
+def release_blob_claim(digest, owner):
+    try:
+        release_lease(digest, owner)
+    except Exception as e:
+        # The claim simply expires after BLOB_CLAIM_TTL
+        logger.warning(f"Release blob claim failed {digest}: {e}")
+
+
+def wait_for_blob(db, digest, size=None):
+    """
+    查找已存储的 blob；其他上传正在写入同一摘要时等待其完成。
+    没有进行中的写入、写入方放弃或等待超过 BLOB_CLAIM_WAIT 时返回 None。
+    """
+    deadline = time.monotonic() + settings.BLOB_CLAIM_WAIT
+    while True:
+        blob = find_blob(db, digest, size)
+        if blob or not lease_active(digest) or time.monotonic() >= deadline:
+            return blob
+        time.sleep(_CLAIM_POLL_INTERVAL)
+        # End the read snapshot so the writer's commit becomes visible
+        db.rollback()
+
+
+def acquire_blob(db, digest):
+    """
+    为已存储的 blob 增加一次引用；blob 不存在时返回 False。
+    调用方负责提交事务。
+    """
+    updated = (
+        db.query(Blob)
+        .filter(Blob.sha256 == digest)
+        .update({Blob.refcount: Blob.refcount + 1}, synchronize_session=False)
+    )
+    return updated > 0
+
+
+def store_blob(db, tmp_path, digest, size, mime_type):
+    """
+    将已计算好摘要的临时文件存入 blob 仓库，内容相同则复用已有文件。
+    返回 (path, created)；调用方提交事务，回滚时若 created 为 True 需删除 path。
+    """
+    for _ in range(3):
+        if acquire_blob(db, digest):
+            blob = db.query(Blob).filter_by(sha256=digest).first()
+            if blob.verified and os.path.exists(blob.path):
+                _discard(tmp_path)
+                return blob.path, False
+            # The row outlived its file, or its content was never checked:
+            # replace it with this upload, which was hashed on the way in
+            adjust_counter(db, STORAGE_BYTES_COUNTER, size - blob.size)
+            db.query(Blob).filter(Blob.sha256 == digest).update(
+                {Blob.size: size, Blob.verified: True}, synchronize_session=False
+            )
+            _move_into_place(tmp_path, blob.path)
+            return blob.path, False
+
+        path = blob_path(digest)
+        # Inserting locks the row until commit, so a concurrent release
+        # cannot unlink the file we are about to move into place. A clash
+        # leaves the caller's transaction intact: acquire the winner's row
+        inserted = db.execute(
+            insert_ignore(Blob).values(
+                sha256=digest,
+                path=path,
+                size=size,
+                mime_type=mime_type,
+                refcount=1,
+                verified=True,
+            )
+        ).rowcount
+        if not inserted:
+            continue
+        adjust_counter(db, STORAGE_BYTES_COUNTER, size)
+        _move_into_place(tmp_path, path)
+        return path, True
+
+    raise RuntimeError(f"Could not store blob {digest}")
+
+
+def release_blob(db, digest):
+    """
+    减少一次引用，最后一个引用释放时删除文件，返回释放的字节数。
+    文件在提交前删除，此时行锁仍在，不会与并发写入同一摘要冲突。
+    """
+    db.query(Blob).filter(Blob.sha256 == digest).update(
+        {Blob.refcount: Blob.refcount - 1}, synchronize_session=False
+    )
+    blob = db.query(Blob).filter_by(sha256=digest).first()
+    if not blob:
+        return 0
+    path = blob.path
+    deleted = (
+        db.query(Blob)
+        .filter(Blob.sha256 == digest, Blob.refcount <= 0)
+        .delete(synchronize_session=False)
+    )
+    if not deleted:
+        return 0
+    adjust_counter(db, STORAGE_BYTES_COUNTER, -blob.size)
+    db.expunge(blob)
+    _discard(path)
+    logger.info(f"Deleted file: {path}")
+    return blob.size
+
+
+def purge_blob(db, digest):
+    """
+    不论引用计数删除 blob 行和文件，返回释放的字节数。
+    用于内容与摘要不符的 blob；调用方负责提交事务。
+    """
+    blob = db.query(Blob).filter_by(sha256=digest).first()
+    if not blob:
+        return 0
+    deleted = (
+        db.query(Blob).filter(Blob.sha256 == digest).delete(synchronize_session=False)
+    )
+    if not deleted:
+        return 0
+    adjust_counter(db, STORAGE_BYTES_COUNTER, -blob.size)
+    db.expunge(blob)
+    _discard(blob.path)
+    logger.info(f"Purged blob: {blob.path}")
+    return blob.size
+
+
+def release_clip_files(db, clip):
+    if clip.file_hash:
+        return release_blob(db, clip.file_hash)
+    if clip.file_path:
+        # Stored before hashing finished, so it was never shared or counted
+        _discard(clip.file_path)
+    return 0
+
+
+def release_bundle_members(db, clip_ids):
+    """
+    释放多文件剪贴板成员引用的 blob 并删除成员行，返回释放的字节数。
+    调用方负责提交事务。
+    """
+    if not clip_ids:
+        return 0
+    members = (
+        db.query(ClipFile.id, ClipFile.file_hash)
+        .filter(ClipFile.clip_id.in_(clip_ids))
+        .all()
+    )
+    freed = sum(release_blob(db, member.file_hash) for member in members)
+    db.query(ClipFile).filter(ClipFile.clip_id.in_(clip_ids)).delete(
+        synchronize_session=False
+    )
+    return freed
+
+
+def delete_clip(db, clip):
+    """
+    删除剪贴板并释放其文件引用；行已被并发删除时不重复释放。
+    返回因此删除的 blob 字节数（仍被其他剪贴板引用的不计）。
+    调用方负责提交事务。
+    """
+    deleted = (
+        db.query(Clip).filter(Clip.id == clip.id).delete(synchronize_session=False)
+    )
+    if not deleted:
+        return 0
+    freed = release_clip_files(db, clip)
+    if clip.content_type == "bundle":
+        freed += release_bundle_members(db, [clip.id])
+    recycle_codes(db, [clip.code])
+    clip_cache.invalidate(clip.code)
+    return freed
@@ -18,3 +18,28 @@ def get_real_ip(request: Request) -> Optional[str]:
             return ip
 
     return request.client.host if request.client else None
+
+
+def accepts_encoding(request: Request, encoding: str) -> bool:
+    """
+    判断客户端的 Accept-Encoding 是否接受指定编码（q=0 视为拒绝）。
+    """
+    header = request.headers.get("accept-encoding")
+    if not header:
+        return False
+
+    accepted = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+
+    q = accepted.get(encoding, accepted.get("*", 0.0))
+    return q > 0
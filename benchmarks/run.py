@@ -0,0 +1,499 @@
+"""
+ClipBox 基准测试。
+
+在临时目录中以 SQLite 启动一个 uvicorn 实例，依次运行各负载，
+统计 p50/p99 延迟、每秒请求数、磁盘写入字节与服务进程峰值内存，结果写入 JSON。
+传入 --compare 时与之前保存的基线对比，有指标退化超过阈值时以非零状态退出。
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --compare baseline.json
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BLOCK_SIZE = 1024 * 1024
+
+WORKLOADS = ("text_burst", "hot_link", "upload_hash", "upload_nohash", "upload_raw")
+
+# Metrics where a larger value is worse
+LOWER_IS_BETTER = ("p50_ms", "p99_ms", "disk_write_bytes")
+HIGHER_IS_BETTER = ("rps",)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _read_proc(pid, name):
+    try:
+        with open(f"/proc/{pid}/{name}") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def _peak_rss(pid):
+    for line in _read_proc(pid, "status").splitlines():
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def _write_bytes(pid):
+    for line in _read_proc(pid, "io").splitlines():
+        if line.startswith("write_bytes:"):
+            return int(line.split()[1])
+    return None
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Server:
+    def __init__(self, workdir, port):
+        self.workdir = workdir
+        self.port = port
+        self.process = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update(
+            {
+                "DATABASE_URL": f"sqlite:///{os.path.join(self.workdir, 'bench.db')}",
+                "DATA_DIR": os.path.join(self.workdir, "data"),
+                # All traffic comes from one address; measure the handlers
+                "RATE_LIMIT_ENABLED": "false",
+            }
+        )
+        self.log = open(os.path.join(self.workdir, "server.log"), "wb")
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "main:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(self.port),
+                "--log-level",
+                "warning",
+            ],
+            cwd=PROJECT_ROOT,
+            env=env,
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Server exited during startup, see server.log")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                conn.request("GET", "/metrics")
+                conn.getresponse().read()
+                conn.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("Server did not start within 30s")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+
+class Client:
+    """
+    每个线程持有一个 keep-alive 连接。
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=300)
+            self._local.conn = conn
+        return conn
+
+    def request(self, method, path, body=None, headers=None):
+        conn = self._conn()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            data = response.read()
+            return response.status, data
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            raise
+
+    def post_form(self, path, fields):
+        body = urlencode(fields).encode()
+        return self.request(
+            "POST",
+            path,
+            body=body,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
+
+
+def _upload_blocks(seed, size):
+    # Unique per upload so no two uploads deduplicate against each other
+    block = hashlib.sha256(seed).digest() * (BLOCK_SIZE // 32)
+    remaining = size
+    counter = 0
+    while remaining > 0:
+        chunk = counter.to_bytes(8, "big") + block[8:]
+        chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        counter += 1
+        yield chunk
+
+
+def _content_hash(seed, size):
+    h = hashlib.sha256()
+    for chunk in _upload_blocks(seed, size):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def _multipart_upload(client, seed, size, client_hash):
+    fields = {"count": "1", "expire": "3600"}
+    if client_hash:
+        fields["client_sha256"] = client_hash
+
+    boundary = uuid.uuid4().hex
+    head = b""
+    for name, value in fields.items():
+        head += (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n"
+        ).encode()
+    head += (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="bench.bin"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def body():
+        yield head
+        yield from _upload_blocks(seed, size)
+        yield tail
+
+    return client.request(
+        "POST",
+        "/clip/upload",
+        body=body(),
+        headers={
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(head) + size + len(tail)),
+        },
+    )
+
+
+def _raw_upload(client, seed, size, client_hash):
+    query = {"filename": "bench.bin", "count": "1", "expire": "3600"}
+    if client_hash:
+        query["client_sha256"] = client_hash
+    return client.request(
+        "PUT",
+        f"/clip/upload/raw?{urlencode(query)}",
+        body=_upload_blocks(seed, size),
+        headers={
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(size),
+        },
+    )
+
+
+def _run_timed(fn, total, concurrency):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = fn(i)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "rps": round(total / duration, 2) if duration else None,
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+    }
+
+
+def workload_text_burst(client, args):
+    text = "benchmark line\n" * 64
+
+    def create(i):
+        status, _ = client.post_form(
+            "/clip/create", {"content": f"{i}\n{text}", "count": 1, "expire": 3600}
+        )
+        return status == 200
+
+    return _run_timed(create, args.requests, args.concurrency)
+
+
+def workload_hot_link(client, args):
+    status, data = client.post_form(
+        "/clip/create",
+        {
+            "content": "https://example.com/benchmark",
+            "link": "yes",
+            "count": args.requests * 2,
+            "expire": 3600,
+        },
+    )
+    if status != 200:
+        raise RuntimeError(f"Could not create link clip: {status} {data!r}")
+    code = json.loads(data)["code"]
+
+    def fetch(i):
+        status, _ = client.request("GET", f"/clip/{code}")
+        return status == 302
+
+    return _run_timed(fetch, args.requests, args.concurrency)
+
+
+def _workload_upload(client, args, with_hash, send=_multipart_upload):
+    size = args.upload_size_mb * 1024 * 1024
+    seeds = [uuid.uuid4().bytes for _ in range(args.uploads)]
+    # Hash outside the timed section, a real client hashes before sending
+    hashes = [_content_hash(seed, size) if with_hash else None for seed in seeds]
+
+    def upload(i):
+        status, _ = send(client, seeds[i], size, hashes[i])
+        return status == 200
+
+    result = _run_timed(upload, args.uploads, args.upload_concurrency)
+    result["upload_bytes"] = size * args.uploads
+    result["throughput_mb_s"] = round(
+        size * args.uploads / 1024 / 1024 / result["duration_s"], 2
+    )
+    return result
+
+
+def workload_upload_hash(client, args):
+    return _workload_upload(client, args, True)
+
+
+def workload_upload_nohash(client, args):
+    return _workload_upload(client, args, False)
+
+
+def workload_upload_raw(client, args):
+    return _workload_upload(client, args, False, send=_raw_upload)
+
+
+def _git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=PROJECT_ROOT,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="clipbox-bench-")
+    server = Server(workdir, args.port or _free_port())
+    results = {
+        "meta": {
+            "revision": _git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "uploads": args.uploads,
+                "upload_concurrency": args.upload_concurrency,
+                "upload_size_mb": args.upload_size_mb,
+            },
+        },
+        "workloads": {},
+    }
+    try:
+        server.start()
+        client = Client(server.port)
+        pid = server.process.pid
+        for name in args.workloads:
+            before = _write_bytes(pid)
+            print(f"running {name} ...", file=sys.stderr)
+            result = globals()[f"workload_{name}"](client, args)
+            after = _write_bytes(pid)
+            result["disk_write_bytes"] = (
+                after - before if before is not None and after is not None else None
+            )
+            results["workloads"][name] = result
+        results["server"] = {
+            "peak_rss_bytes": _peak_rss(pid),
+            "data_dir_bytes": _dir_size(os.path.join(workdir, "data")),
+        }
+    finally:
+        server.stop()
+        if args.keep:
+            print(f"kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(baseline, current, threshold):
+    """
+    打印与基线的对比，返回退化的指标列表。
+    """
+    regressions = []
+    rows = []
+    for name, result in current["workloads"].items():
+        base = baseline.get("workloads", {}).get(name)
+        if not base:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = (
+                change > threshold
+                if metric in LOWER_IS_BETTER
+                else (change < -threshold)
+            )
+            rows.append((name, metric, old, new, change, worse))
+            if worse:
+                regressions.append(f"{name}.{metric}")
+
+    old_rss = baseline.get("server", {}).get("peak_rss_bytes")
+    new_rss = current.get("server", {}).get("peak_rss_bytes")
+    if old_rss and new_rss:
+        change = (new_rss - old_rss) / old_rss
+        rows.append(("server", "peak_rss_bytes", old_rss, new_rss, change, False))
+        if change > threshold:
+            regressions.append("server.peak_rss_bytes")
+            rows[-1] = rows[-1][:5] + (True,)
+
+    for name, metric, old, new, change, worse in rows:
+        flag = "  REGRESSION" if worse else ""
+        print(f"{name:16} {metric:18} {old:>14} -> {new:>14} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ClipBox end to end.")
+    parser.add_argument(
+        "--workloads",
+        nargs="+",
+        choices=WORKLOADS,
+        default=list(WORKLOADS),
+        help="workloads to run, in order",
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--uploads", type=int, default=4)
+    parser.add_argument("--upload-concurrency", type=int, default=4)
+    parser.add_argument("--upload-size-mb", type=int, default=100)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="relative change counted as a regression (default 0.10)",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the temp directory and server log"
+    )
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
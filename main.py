@@ -1,14 +1,38 @@
 import uvicorn
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse, Response
+from fastapi.responses import Response
 from app.routes import api_router
-from app.database import init_database
+from app.migrations import ensure_schema
+from app.cache import clip_cache
+from app.codes import secret_key
+from app.scheduler import expiry_scheduler
+from app.hashing import hash_pool
+from app.metrics import MetricsMiddleware
+from app.ratelimit import RateLimitMiddleware
+from app.static import StaticSite
 import os
 
-app = FastAPI(title="ClipBox")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Delete expired clips and files in the background
+    expiry_scheduler.start()
+    # Resume hash verifications left over from the last run
+    hash_pool.start()
+    yield
+    hash_pool.stop()
+    expiry_scheduler.stop()
+    # Write back access counts consumed from the read cache
+    clip_cache.flush()
+
+
+app = FastAPI(title="ClipBox", lifespan=lifespan)
+
+# Middleware added later wraps the earlier ones: CORS must wrap the rate
+# limiter so its 429/503 responses are readable cross-origin
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -16,9 +40,13 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
-# Initialize database
-init_database()
+# Check the schema version, migrating first if this worker wins the lock
+ensure_schema()
+# Persist the shared secret up front: created lazily inside a request, its
+# INSERT would wait on the SQLite write lock the request itself holds
+secret_key("resume")
 
 # Include API routers
 app.include_router(api_router, prefix="")
@@ -28,33 +56,15 @@ project_root = os.path.dirname(__file__)
 www_root = os.path.join(project_root, "www")
 
 if os.path.exists(www_root):
-    app.mount(
-        "/assets",
-        StaticFiles(directory=os.path.join(www_root, "assets")),
-        name="assets",
-    )
-
-    @app.get("/{full_path:path}")
-    def serve_frontend(full_path: str):
-        # Allow requests to /api to pass through to the 404 handler if they don't match
-        if full_path.startswith("api/"):
-            return JSONResponse({"detail": "Not Found"}, status_code=404)
-
-        # If it's a file request (e.g., .js, .css, .ico)
-        path = os.path.join(www_root, full_path)
-        if os.path.isfile(path):
-            return FileResponse(path)
-
-        # Try finding an index.html if it's a directory
-        index_path = os.path.join(path, "index.html")
-        if os.path.isfile(index_path):
-            return FileResponse(index_path)
-
-        # Fallback to SPA root index.html
-        return FileResponse(os.path.join(www_root, "index.html"))
+    static_site = StaticSite(www_root)
+
+    @app.api_route("/{full_path:path}", methods=["GET", "HEAD"])
+    def serve_frontend(full_path: str, request: Request):
+        return static_site.response(request, full_path)
+
 else:
 
-    @app.get("/{full_path:path}")
+    @app.api_route("/{full_path:path}", methods=["GET", "HEAD"])
     def api_fallback(full_path: str):
         return Response("Clipbox-API", media_type="text/plain")
 
@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Settings are read when app.config is imported, so point the app at a
+# throwaway SQLite database before anything imports it
+_TMP_DIR = tempfile.mkdtemp(prefix="clipbox-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_TMP_DIR}/clipbox.db"
+os.environ["DATA_DIR"] = os.path.join(_TMP_DIR, "data")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402  runs ensure_schema()
+from app.database import SessionLocal  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
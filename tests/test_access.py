@@ -0,0 +1,85 @@
+import threading
+from datetime import datetime, timedelta
+
+from app.codes import allocate_code
+from app.database import Clip, SessionLocal, consume_access
+
+
+def _create_clip(db, count, content_type="text/plain", expires_in=3600):
+    clip = Clip(
+        code=allocate_code(),
+        content_type=content_type,
+        content="hello",
+        access_count=count,
+        max_count=count,
+        expire_seconds=expires_in,
+        expires_at=datetime.utcnow() + timedelta(seconds=expires_in),
+    )
+    db.add(clip)
+    db.commit()
+    return clip
+
+
+def test_consume_access_stops_at_zero(db):
+    clip = _create_clip(db, 2)
+    results = []
+    for _ in range(3):
+        results.append(consume_access(db, clip.code))
+        db.commit()
+    assert results == [True, True, False]
+    db.refresh(clip)
+    assert clip.access_count == 0
+    assert clip.expires_at <= datetime.utcnow()
+
+
+def test_consume_access_concurrent_limit(db):
+    count = 5
+    clip = _create_clip(db, count)
+    barrier = threading.Barrier(20)
+    results = []
+    lock = threading.Lock()
+
+    def hit():
+        session = SessionLocal()
+        try:
+            barrier.wait()
+            allowed = consume_access(session, clip.code)
+            session.commit()
+        finally:
+            session.close()
+        with lock:
+            results.append(allowed)
+
+    threads = [threading.Thread(target=hit) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results.count(True) == count
+    db.refresh(clip)
+    assert clip.access_count == 0
+
+
+def test_consume_access_expired_clip(db):
+    clip = _create_clip(db, 3)
+    clip.expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.commit()
+    assert not consume_access(db, clip.code)
+
+
+def test_last_file_access_keeps_resume_grace(db):
+    clip = _create_clip(db, 1, content_type="file")
+    assert consume_access(db, clip.code)
+    db.commit()
+    db.refresh(clip)
+    assert clip.access_count == 0
+    assert clip.expires_at > datetime.utcnow()
+
+
+def test_last_bundle_access_expires_now(db):
+    clip = _create_clip(db, 1, content_type="bundle")
+    assert consume_access(db, clip.code)
+    db.commit()
+    db.refresh(clip)
+    assert clip.expires_at <= datetime.utcnow()
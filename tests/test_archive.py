@@ -0,0 +1,43 @@
+import io
+import os
+import zipfile
+from datetime import datetime
+
+import pytest
+
+from app.archive import stream_zip
+
+
+@pytest.mark.parametrize("deflate", [False, True])
+def test_stream_zip_roundtrip(tmp_path, deflate):
+    contents = {
+        "a.txt": b"hello world\n" * 100,
+        "dir/b.bin": os.urandom(3 * 1024 * 1024 + 17),
+        "empty": b"",
+    }
+    members = []
+    for name, data in contents.items():
+        path = tmp_path / name.replace("/", "_")
+        path.write_bytes(data)
+        members.append((name, str(path), len(data), datetime(2024, 5, 6, 7, 8, 10)))
+
+    archive = b"".join(stream_zip(members, deflate=deflate))
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == list(contents)
+        for name, data in contents.items():
+            info = zf.getinfo(name)
+            assert info.file_size == len(data)
+            assert info.date_time == (2024, 5, 6, 7, 8, 10)
+            expected = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+            assert info.compress_type == expected
+            assert zf.read(name) == data
+
+
+def test_stream_zip_old_timestamp(tmp_path):
+    path = tmp_path / "old"
+    path.write_bytes(b"x")
+    archive = b"".join(stream_zip([("old", str(path), 1, datetime(1970, 1, 1))]))
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.getinfo("old").date_time == (1980, 1, 1, 0, 0, 0)
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+from app.codes import CodeAllocator, _keyspace
+from app.config import settings
+from app.database import FreeCode, engine, recycle_codes
+
+
+def test_permute_is_a_permutation():
+    allocator = CodeAllocator()
+    allocator._key = b"k" * 32
+    length = 3
+    codes = [allocator._permute(seq, length) for seq in range(_keyspace(length))]
+    assert len(set(codes)) == len(codes)
+    assert all(len(code) == length and code[0] != "0" for code in codes)
+
+
+def test_permute_depends_on_key():
+    a, b = CodeAllocator(), CodeAllocator()
+    a._key, b._key = b"a" * 32, b"b" * 32
+    seqs = range(200)
+    assert [a._permute(s, 5) for s in seqs] != [b._permute(s, 5) for s in seqs]
+
+
+def test_allocate_many_unique():
+    allocator = CodeAllocator()
+    codes = allocator.allocate_many(500) + [allocator.allocate() for _ in range(50)]
+    assert len(set(codes)) == len(codes)
+    assert all(len(code) >= settings.CODE_MIN_LENGTH for code in codes)
+
+
+def test_two_allocators_do_not_collide():
+    a, b = CodeAllocator(), CodeAllocator()
+    codes = a.allocate_many(200) + b.allocate_many(200)
+    assert len(set(codes)) == len(codes)
+
+
+def test_recycled_codes_reused_after_delay(db, monkeypatch):
+    freed = CodeAllocator().allocate_many(3)
+    recycle_codes(db, freed)
+    db.commit()
+
+    # Still inside the delay: the allocator issues fresh codes
+    allocator = CodeAllocator()
+    assert not set(allocator.allocate_many(3)) & set(freed)
+
+    monkeypatch.setattr(settings, "CODE_RECYCLE_DELAY", 0)
+    db.query(FreeCode).filter(FreeCode.code.in_(freed)).update(
+        {FreeCode.freed_at: datetime.utcnow() - timedelta(seconds=1)},
+        synchronize_session=False,
+    )
+    db.commit()
+    reused = CodeAllocator().allocate_many(3)
+    assert sorted(reused) == sorted(freed)
+    with engine.connect() as conn:
+        remaining = conn.execute(
+            FreeCode.__table__.select().where(FreeCode.code.in_(freed))
+        ).all()
+    assert remaining == []
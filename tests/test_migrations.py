@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+from app.migrations import LATEST_VERSION, current_version
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# cb_clips as created by the first release, before the migration ledger
+BASELINE_SCHEMA = """
+CREATE TABLE cb_clips (
+    id INTEGER NOT NULL PRIMARY KEY,
+    code VARCHAR(10) NOT NULL,
+    content_type VARCHAR(10) NOT NULL,
+    content TEXT,
+    filename VARCHAR(255),
+    file_path VARCHAR(500),
+    file_hash VARCHAR(64),
+    file_size BIGINT,
+    mime_type VARCHAR(100),
+    client_ip VARCHAR(45),
+    access_count INTEGER NOT NULL,
+    max_count INTEGER NOT NULL,
+    expire_seconds INTEGER NOT NULL,
+    created_at DATETIME,
+    updated_at DATETIME
+);
+CREATE UNIQUE INDEX ix_cb_clips_code ON cb_clips (code);
+CREATE INDEX ix_cb_clips_file_hash ON cb_clips (file_hash);
+CREATE INDEX ix_cb_clips_created_at ON cb_clips (created_at);
+"""
+
+# Runs in a fresh interpreter so settings and the engine pick up the
+# baseline database; importing main applies the migrations
+UPGRADE_SCRIPT = """
+import json, sys, time
+from fastapi.testclient import TestClient
+import main
+from app.migrations import current_version
+from app.database import engine
+from sqlalchemy import inspect, text
+
+client = TestClient(main.app)
+started = time.monotonic()
+file_resp = client.get("/clip/10001")
+text_resp = client.get("/clip/10002")
+elapsed = time.monotonic() - started
+with engine.connect() as conn:
+    columns = [c["name"] for c in inspect(conn).get_columns("cb_clips")]
+    blobs = conn.execute(text("SELECT sha256, refcount FROM cb_blobs")).all()
+    expires = conn.execute(
+        text("SELECT expires_at FROM cb_clips WHERE code = '10002'")
+    ).scalar()
+json.dump(
+    {
+        "version": current_version(),
+        "columns": columns,
+        "blobs": [list(b) for b in blobs],
+        "expires_at": str(expires),
+        "file_status": file_resp.status_code,
+        "file_body": file_resp.content.decode("latin-1"),
+        "text_status": text_resp.status_code,
+        "text_body": text_resp.text,
+        "elapsed": elapsed,
+    },
+    sys.stdout,
+)
+"""
+
+
+def _baseline_db(tmp_path):
+    data_dir = tmp_path / "data"
+    uploads = data_dir / "uploads"
+    uploads.mkdir(parents=True)
+    content = b"stored before the blob table\n"
+    digest = hashlib.sha256(content).hexdigest()
+    legacy_path = uploads / "legacy.txt"
+    legacy_path.write_bytes(content)
+
+    created = datetime.utcnow() - timedelta(hours=1)
+    conn = sqlite3.connect(tmp_path / "baseline.db")
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO cb_clips (code, content_type, content, filename, file_path,"
+        " file_hash, file_size, mime_type, access_count, max_count,"
+        " expire_seconds, created_at, updated_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                "10001",
+                "file",
+                None,
+                "legacy.txt",
+                str(legacy_path),
+                digest,
+                len(content),
+                "text/plain",
+                10,
+                10,
+                86400,
+                created,
+                created,
+            ),
+            (
+                "10002",
+                "text/plain",
+                "legacy text",
+                None,
+                None,
+                None,
+                None,
+                None,
+                10,
+                10,
+                86400,
+                created,
+                created,
+            ),
+        ],
+    )
+    conn.commit()
+    conn.close()
+    return data_dir, content, digest, created
+
+
+def test_upgrade_baseline_schema(tmp_path):
+    data_dir, content, digest, created = _baseline_db(tmp_path)
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{tmp_path}/baseline.db",
+        DATA_DIR=str(data_dir),
+        PYTHONPATH=ROOT,
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", UPGRADE_SCRIPT],
+        cwd=tmp_path,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert proc.returncode == 0, proc.stderr
+    result = json.loads(proc.stdout)
+
+    assert result["version"] == LATEST_VERSION
+    for column in (
+        "expires_at",
+        "content_blob",
+        "content_encoding",
+        "last_accessed_at",
+    ):
+        assert column in result["columns"]
+    assert result["blobs"] == [[digest, 1]]
+    expected_expiry = created + timedelta(seconds=86400)
+    assert result["expires_at"].startswith(expected_expiry.strftime("%Y-%m-%d %H:%M"))
+
+    # Serving a legacy file must not wait on the SQLite write lock
+    assert result["file_status"] == 200
+    assert result["file_body"].encode("latin-1") == content
+    assert result["text_status"] == 200
+    assert "legacy text" in result["text_body"]
+    assert result["elapsed"] < 5
+
+
+def test_ledger_is_current():
+    assert current_version() == LATEST_VERSION
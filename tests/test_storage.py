@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+import pytest
+
+from app.database import STORAGE_BYTES_COUNTER, Blob, read_counter
+from app.storage import (
+    FileTooLarge,
+    release_blob,
+    save_chunks,
+    store_blob,
+    temp_upload_path,
+)
+
+
+def _upload(data):
+    tmp_path = temp_upload_path()
+    size, digest = save_chunks([data], tmp_path)
+    return tmp_path, size, digest
+
+
+def test_save_chunks_hashes_content():
+    data = os.urandom(3000)
+    tmp_path, size, digest = _upload(data)
+    assert size == len(data)
+    assert digest == hashlib.sha256(data).hexdigest()
+    with open(tmp_path, "rb") as f:
+        assert f.read() == data
+    os.remove(tmp_path)
+
+
+def test_save_chunks_max_size():
+    tmp_path = temp_upload_path()
+    with pytest.raises(FileTooLarge):
+        save_chunks([b"x" * 10, b"y" * 10], tmp_path, max_size=15)
+    assert not os.path.exists(tmp_path)
+
+
+def test_store_and_release_refcounts(db):
+    data = os.urandom(5000)
+    before = read_counter(STORAGE_BYTES_COUNTER)
+
+    tmp_path, size, digest = _upload(data)
+    path, created = store_blob(db, tmp_path, digest, size, "application/octet-stream")
+    db.commit()
+    assert created
+    assert os.path.exists(path)
+    assert not os.path.exists(tmp_path)
+    assert read_counter(STORAGE_BYTES_COUNTER) == before + size
+
+    # Same content again shares the file and is not counted twice
+    tmp_path, size, digest = _upload(data)
+    path2, created = store_blob(db, tmp_path, digest, size, "application/octet-stream")
+    db.commit()
+    assert path2 == path
+    assert not created
+    assert not os.path.exists(tmp_path)
+    assert db.query(Blob).filter_by(sha256=digest).one().refcount == 2
+    assert read_counter(STORAGE_BYTES_COUNTER) == before + size
+
+    assert release_blob(db, digest) == 0
+    db.commit()
+    assert os.path.exists(path)
+    assert db.query(Blob).filter_by(sha256=digest).one().refcount == 1
+
+    assert release_blob(db, digest) == size
+    db.commit()
+    assert not os.path.exists(path)
+    assert db.query(Blob).filter_by(sha256=digest).first() is None
+    assert read_counter(STORAGE_BYTES_COUNTER) == before
+
+
+def test_release_missing_blob(db):
+    before = read_counter(STORAGE_BYTES_COUNTER)
+    assert release_blob(db, "0" * 64) == 0
+    db.commit()
+    assert read_counter(STORAGE_BYTES_COUNTER) == before